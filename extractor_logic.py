@@ -1,13 +1,18 @@
 import os
-import json
-import re
 import asyncio
+import functools
+import hashlib
+import io
+import re
+import threading
+from pathlib import Path
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, ValidationError
 from typing import List
-from schema import Transaction, StatementMetadata
+from schema import Transaction, StatementMetadata, get_cached_extraction, save_cached_extraction
 from google.adk.agents.llm_agent import Agent
 from google.adk.runners import InMemoryRunner
+from google.adk.utils.context_utils import Aclosing
 from google.genai import types
 
 load_dotenv(override=True)
@@ -16,81 +21,329 @@ load_dotenv(override=True)
 if not os.getenv("GOOGLE_API_KEY") and os.getenv("GEMINI_API_KEY"):
     os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
 
+EXTRACTION_MODEL = "gemini-2.5-flash"
+
+# Extraction results keyed by model + statement content, so unchanged statements skip the LLM on re-runs
+EXTRACTION_CACHE_DIR = Path(os.getenv("EXTRACTION_CACHE_DIR", "~/.cache/expense_explorer/extractions")).expanduser()
+
+# Anything shorter than this, or without a single digit, cannot hold a dated, priced transaction
+MIN_STATEMENT_CHARS = 200
+_DIGIT_RE = re.compile(r"\d")
+
+# Statement boilerplate that costs prompt tokens without carrying transactions
+# Horizontal whitespace only: a \s* here would span newlines and backtrack quadratically over blank runs
+_NOISE_LINE_RE = re.compile(r"^[ \t]*(?:Page \d+.*|©.*|www\.\S+|Member FDIC.*)[ \t]*$", re.IGNORECASE | re.MULTILINE)
+_BLANK_RUN_RE = re.compile(r"\n\s*\n\s*")
+_INLINE_SPACE_RE = re.compile(r"[ \t]{2,}")
+_EMPTY_FRAGMENT_RE = re.compile(r"^(TEXT|TABLE|LIST):$")
+
+# parse_to_markdown separates pages with this marker. Statements longer than
+# SINGLE_SHOT_MAX_CHARS are split on it and extracted as parallel page chunks;
+# anything shorter goes to the model in one call.
+PAGE_DELIMITER = "<!--PAGE-->"
+SINGLE_SHOT_MAX_CHARS = 60_000
+
+# A single long-lived event loop on a daemon thread drives every ADK call. Sync callers
+# (including worker threads) submit coroutines to it instead of patching their own loop.
+_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, name="extractor-event-loop", daemon=True).start()
+
+def _run_sync(coro):
+    """Runs a coroutine on the extractor event loop and blocks until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _LOOP).result()
+
 class TransactionList(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     summary: StatementMetadata | None = None
     transactions: List[Transaction]
 
-def _run_async_logic(runner, new_message, user_id, session_id):
-    """Bridge to collect events from the async runner logic."""
-    full_output = []
-    
-    async def _collect():
-        from google.adk.utils.context_utils import Aclosing
-        async with Aclosing(runner.run_async(user_id=user_id, session_id=session_id, new_message=new_message)) as agen:
+class BatchedTransactionList(TransactionList):
+    doc: int
+
+class TransactionBatch(BaseModel):
+    statements: List[BatchedTransactionList]
+
+def has_statement_content(markdown_content: str) -> bool:
+    """Cheap pre-check that parsed markdown could contain transactions at all."""
+    return len(markdown_content) >= MIN_STATEMENT_CHARS and _DIGIT_RE.search(markdown_content) is not None
+
+def _compress_markdown(markdown_content: str) -> str:
+    """
+    Shrinks parsed statement markdown before it is sent to the model: drops page
+    numbers, URLs and legal footers, collapses padding and blank lines, and keeps
+    only the first copy of fragments repeated on every page (headers, disclaimers).
+    """
+    text = _NOISE_LINE_RE.sub("", markdown_content.replace(PAGE_DELIMITER, ""))
+    text = _INLINE_SPACE_RE.sub(" ", text)
+
+    seen_blocks = set()
+    blocks = []
+    for block in _BLANK_RUN_RE.split(text):
+        block = block.strip()
+        if block and not _EMPTY_FRAGMENT_RE.match(block) and block not in seen_blocks:
+            seen_blocks.add(block)
+            blocks.append(block)
+    return "\n\n".join(blocks)
+
+def _split_pages(markdown_content: str, max_chars: int) -> List[str]:
+    """Groups consecutive pages into chunks of at most `max_chars` (a single oversized page stays whole)."""
+    chunks, current, size = [], [], 0
+    for page in markdown_content.split(PAGE_DELIMITER):
+        if current and size + len(page) > max_chars:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(page)
+        size += len(page)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def _merge_extractions(results: List[TransactionList]) -> TransactionList:
+    """Concatenates per-chunk transactions and fills each summary field from the first chunk that has it."""
+    summaries = [r.summary for r in results if r.summary]
+    summary = None
+    if summaries:
+        summary = StatementMetadata(**{
+            field: next((getattr(s, field) for s in summaries if getattr(s, field) is not None), None)
+            for field in StatementMetadata.model_fields
+        })
+    return TransactionList(summary=summary, transactions=[tx for r in results for tx in r.transactions])
+
+def _cache_key(markdown_content: str) -> str:
+    return hashlib.sha256(f"{EXTRACTION_MODEL}\n{markdown_content}".encode()).hexdigest()
+
+def _cache_path(markdown_content: str) -> Path:
+    return EXTRACTION_CACHE_DIR / f"{_cache_key(markdown_content)}.json"
+
+def _load_cached_extraction(markdown_content: str) -> TransactionList | None:
+    """
+    Returns a previously extracted TransactionList for identical content, if any: from the
+    local disk cache first, then from the database, which outlives serverless containers.
+    """
+    cache_path = _cache_path(markdown_content)
+    if cache_path.exists():
+        try:
+            return TransactionList.model_validate_json(cache_path.read_bytes())
+        except (OSError, ValidationError) as e:
+            print(f"Ignoring unreadable extraction cache entry {cache_path.name}: {e}")
+            return None
+
+    try:
+        payload = get_cached_extraction(_cache_key(markdown_content))
+        if payload is None:
+            return None
+        result = TransactionList.model_validate_json(payload)
+    except Exception as e:
+        print(f"Skipping database extraction cache lookup: {e}")
+        return None
+    _store_cached_extraction_on_disk(cache_path, payload)
+    return result
+
+def _store_cached_extraction_on_disk(cache_path: Path, payload: str) -> None:
+    try:
+        EXTRACTION_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path.write_bytes(payload.encode())
+    except OSError as e:
+        print(f"Could not write extraction cache: {e}")
+
+def _store_cached_extraction(markdown_content: str, result: TransactionList) -> None:
+    payload = result.model_dump_json()
+    _store_cached_extraction_on_disk(_cache_path(markdown_content), payload)
+    try:
+        save_cached_extraction(_cache_key(markdown_content), payload)
+    except Exception as e:
+        print(f"Could not write database extraction cache: {e}")
+
+async def _run_agent(runner: InMemoryRunner, prompt: str) -> str:
+    """Creates a session, streams the agent's events and returns the combined text output."""
+    session = await runner.session_service.create_session(user_id="ingest_user", app_name=runner.app_name)
+    new_message = types.Content(role="user", parts=[types.Part(text=prompt)])
+
+    full_output = io.StringIO()
+    try:
+        async with Aclosing(runner.run_async(user_id=session.user_id, session_id=session.id, new_message=new_message)) as agen:
             async for event in agen:
                 if event.content and event.content.parts:
-                    text = "".join(p.text for p in event.content.parts if p.text)
-                    if text:
-                        full_output.append(text)
-    
-    import nest_asyncio
-    nest_asyncio.apply()
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(_collect())
-    return "".join(full_output)
+                    for part in event.content.parts:
+                        if part.text:
+                            full_output.write(part.text)
+    finally:
+        # The runner is cached for the process, so its session service would otherwise keep
+        # every statement prompt and response alive
+        await runner.session_service.delete_session(app_name=runner.app_name, user_id=session.user_id, session_id=session.id)
+    return full_output.getvalue()
+
+_EXTRACTOR_INSTRUCTION = (
+    "You are an expert financial analyst. Extract all individual transactions and statement-level summary metadata from the provided markdown content.\n\n"
+    "CATEGORIES:\n"
+    "- Dining, Groceries, Travel, Shopping, Utilities, Services, Rent, Credit Card Payment, Internal Transfer, Miscellaneous.\n\n"
+    "TRANSACTION FIELDS (REQUIRED):\n"
+    "- date: YYYY-MM-DD format.\n"
+    "- description: The original or slightly cleaned transaction text from the statement.\n"
+    "- amount: Float.\n"
+    "- category: Choose from CATEGORIES list.\n\n"
+    "TRANSACTION FIELDS (OPTIONAL):\n"
+    "- merchant: The cleaned name of the business.\n"
+    "- location: City/State if found.\n"
+    "- transaction_type: Debit, Credit, etc.\n\n"
+    "OUTPUT FORMAT:\n"
+    "Respond with JSON matching the response schema: statement 'summary' metadata and a 'transactions' list. Ensure every transaction has a 'description' field."
+)
+
+# Static request prefixes. Gemini 2.5 caches repeated prompt prefixes implicitly, so keep
+# everything constant (instruction + these) ahead of the per-statement content.
+_PROMPT_PREFIX = "Please extract all transactions from the following statement content:\n\n"
+_BATCH_PROMPT_PREFIX = (
+    "The following content contains several separate statements, delimited by DOC markers.\n"
+    "Extract each statement independently and return one entry in 'statements' per document, "
+    "with 'doc' set to that document's index.\n\n"
+)
+
+@functools.lru_cache(maxsize=4)
+def _get_runner(model: str, batch: bool = False) -> InMemoryRunner:
+    """Builds the extractor Agent and runner once per model and reuses them for every call."""
+    extractor = Agent(
+        name="TransactionBatchExtractor" if batch else "TransactionExtractor",
+        model=model,
+        instruction=_EXTRACTOR_INSTRUCTION,
+        # Gemini JSON mode: the response is constrained to this schema server-side.
+        output_schema=TransactionBatch if batch else TransactionList
+    )
+    return InMemoryRunner(agent=extractor)
 
 def extract_transactions_agent(markdown_content: str) -> TransactionList:
     """
     Extracts high-fidelity structured transactions from a financial statement.
     Uses Google ADK and Gemini-2.5-Flash-Lite for robust extraction.
     """
-    extractor = Agent(
-        name="TransactionExtractor",
-        model="gemini-2.5-flash",
-        instruction=(
-            "You are an expert financial analyst. Extract all individual transactions and statement-level summary metadata from the provided markdown content.\n\n"
-            "CATEGORIES:\n"
-            "- Dining, Groceries, Travel, Shopping, Utilities, Services, Rent, Credit Card Payment, Internal Transfer, Miscellaneous.\n\n"
-            "TRANSACTION FIELDS (REQUIRED):\n"
-            "- date: YYYY-MM-DD format.\n"
-            "- description: The original or slightly cleaned transaction text from the statement.\n"
-            "- amount: Float.\n"
-            "- category: Choose from CATEGORIES list.\n\n"
-            "TRANSACTION FIELDS (OPTIONAL):\n"
-            "- merchant: The cleaned name of the business.\n"
-            "- location: City/State if found.\n"
-            "- transaction_type: Debit, Credit, etc.\n\n"
-            "OUTPUT FORMAT:\n"
-            "You must output ONLY a valid JSON block containing 'summary' and 'transactions' list. Ensure every transaction has a 'description' field."
-        )
-    )
+    if not has_statement_content(markdown_content):
+        print("Skipping extraction: markdown is too short or contains no digits.")
+        return TransactionList(transactions=[])
 
-    runner = InMemoryRunner(agent=extractor)
-    
-    # Create session using the runner's app_name to ensure consistency
-    import nest_asyncio
-    nest_asyncio.apply()
-    loop = asyncio.get_event_loop()
-    session = loop.run_until_complete(runner.session_service.create_session(user_id="ingest_user", app_name=runner.app_name))
+    cached = _load_cached_extraction(markdown_content)
+    if cached is not None:
+        print("Using cached extraction result.")
+        return cached
+
+    result = _run_sync(_extract_async(markdown_content))
+    _store_cached_extraction(markdown_content, result)
+    return result
+
+async def _extract_async(markdown_content: str) -> TransactionList:
+    """
+    Runs a single-statement extraction on the extractor event loop. Statements too
+    long for one reliable call are split on page boundaries and the chunks extracted concurrently.
+    """
+    if len(markdown_content) > SINGLE_SHOT_MAX_CHARS and PAGE_DELIMITER in markdown_content:
+        chunks = [c for c in _split_pages(markdown_content, SINGLE_SHOT_MAX_CHARS) if has_statement_content(c)]
+        print(f"Statement is {len(markdown_content)} chars; extracting {len(chunks)} page chunks in parallel...")
+        results = await asyncio.gather(*[_extract_single_async(chunk) for chunk in chunks])
+        return _merge_extractions(results)
+    return await _extract_single_async(markdown_content)
+
+async def _extract_single_async(markdown_content: str) -> TransactionList:
+    """Extracts one prompt's worth of statement content."""
+    runner = _get_runner(EXTRACTION_MODEL)
+    prompt = _PROMPT_PREFIX + _compress_markdown(markdown_content)
 
-    prompt = f"Please extract all transactions from the following statement content:\n\n{markdown_content}"
-    new_message = types.Content(role="user", parts=[types.Part(text=prompt)])
-    
     print(f"Running extraction via Google ADK (Gemini 2.5 Flash)...")
-    combined_result = _run_async_logic(runner, new_message, session.user_id, session.id)
-    
-    # Manually parse JSON from result
-    json_match = re.search(r"```json\n(.*?)\n```", combined_result, re.DOTALL)
-    if not json_match:
-        json_match = re.search(r"(\{.*\})", combined_result, re.DOTALL)
-        
-    if json_match:
-        try:
-            data = json.loads(json_match.group(1).strip())
-            return TransactionList.model_validate(data)
-        except Exception as e:
-            print(f"Error parsing JSON from ADK agent: {e}\nRaw output: {combined_result}")
-            raise e
-    else:
-        print(f"No JSON found in ADK agent output: {combined_result}")
+    combined_result = await _run_agent(runner, prompt)
+
+    if not combined_result.strip():
+        print("No output from ADK agent.")
         return TransactionList(transactions=[])
+
+    try:
+        return TransactionList.model_validate_json(combined_result)
+    except ValidationError as e:
+        # JSON mode guarantees the shape, so this only happens on truncated output.
+        print(f"Error parsing JSON from ADK agent: {e}\nRaw output: {combined_result}")
+        raise e
+
+def extract_transactions_batch(markdowns: List[str]) -> List[TransactionList]:
+    """
+    Extracts transactions from several statements in a single Gemini call.
+    Each statement is wrapped in DOC delimiters and the model returns one
+    'statements' entry per document, so the instruction prefix and round-trip are paid once.
+    Results are returned in the same order as `markdowns`; statements already in
+    the extraction cache, or with no extractable content, are not sent to the model.
+    A statement whose extraction fails comes back empty (and uncached) unless every one failed,
+    in which case the first error is raised.
+    """
+    results: List[TransactionList | None] = [
+        _load_cached_extraction(md) if has_statement_content(md) else TransactionList(transactions=[])
+        for md in markdowns
+    ]
+    misses = [i for i, cached in enumerate(results) if cached is None]
+    if len(misses) < len(markdowns):
+        print(f"Using cached extraction results for {len(markdowns) - len(misses)} statement(s).")
+
+    if misses:
+        # Oversized statements would crowd out the rest of a batch, so they take the page-split path
+        batched = [i for i in misses if len(markdowns[i]) <= SINGLE_SHOT_MAX_CHARS]
+        oversized = [i for i in misses if len(markdowns[i]) > SINGLE_SHOT_MAX_CHARS]
+
+        async def _extract_misses():
+            batch_outcome, *oversized_outcomes = await asyncio.gather(
+                _extract_batch_async([markdowns[i] for i in batched]),
+                *[_extract_async(markdowns[i]) for i in oversized],
+                return_exceptions=True,
+            )
+            if isinstance(batch_outcome, ValidationError):
+                # One truncated response shouldn't cost every statement in it; extract them one by one
+                print(f"Batched extraction output was invalid; extracting {len(batched)} statement(s) individually...")
+                batch_outcome = await asyncio.gather(*[_extract_async(markdowns[i]) for i in batched], return_exceptions=True)
+            elif isinstance(batch_outcome, BaseException):
+                batch_outcome = [batch_outcome] * len(batched)
+            return list(batch_outcome) + oversized_outcomes
+
+        errors = []
+        for i, outcome in zip(batched + oversized, _run_sync(_extract_misses())):
+            if isinstance(outcome, BaseException):
+                # Left uncached, so the statement is retried the next time it is ingested
+                print(f"Extraction failed for statement {i}: {outcome}")
+                errors.append(outcome)
+                results[i] = TransactionList(transactions=[])
+            elif outcome is None:
+                # The model skipped this document; don't cache the empty result
+                results[i] = TransactionList(transactions=[])
+            else:
+                results[i] = outcome
+                _store_cached_extraction(markdowns[i], outcome)
+        if len(errors) == len(misses):
+            # Nothing succeeded: surface the error so callers can back off (e.g. on rate limits)
+            raise errors[0]
+    return results
+
+async def _extract_batch_async(markdowns: List[str]) -> List[TransactionList | None]:
+    """Runs one batched Gemini call over `markdowns`; entries the model omitted are None."""
+    if not markdowns:
+        return []
+
+    runner = _get_runner(EXTRACTION_MODEL, batch=True)
+
+    sections = "\n\n".join(
+        f"=== DOC {i} START ===\n{_compress_markdown(md)}\n=== DOC {i} END ===" for i, md in enumerate(markdowns)
+    )
+    prompt = f"{_BATCH_PROMPT_PREFIX}Document count: {len(markdowns)}\n\n{sections}"
+
+    print(f"Running batched extraction of {len(markdowns)} statements via Google ADK (Gemini 2.5 Flash)...")
+    combined_result = await _run_agent(runner, prompt)
+
+    results: List[TransactionList | None] = [None] * len(markdowns)
+    if not combined_result.strip():
+        print("No output from ADK agent.")
+        return results
+
+    try:
+        batch = TransactionBatch.model_validate_json(combined_result)
+    except ValidationError as e:
+        # JSON mode guarantees the shape, so this only happens on truncated output.
+        print(f"Error parsing JSON from ADK agent: {e}\nRaw output: {combined_result}")
+        raise e
+
+    for item in batch.statements:
+        if 0 <= item.doc < len(markdowns):
+            results[item.doc] = TransactionList(summary=item.summary, transactions=item.transactions)
+    return results
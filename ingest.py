@@ -3,11 +3,44 @@ from dotenv import load_dotenv
 load_dotenv(override=True)
 
 import glob
+import functools
 import time
+import itertools
+import queue
+import random
+import threading
+import traceback
 import requests
-from extractor_logic import extract_transactions_agent
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from pydantic import BaseModel
+from extractor_logic import extract_transactions_batch, has_statement_content, PAGE_DELIMITER
 from schema import init_db, save_transactions, Transaction
 
+# Seconds between parse-status polls: short at first so one-page statements return
+# promptly, then a steady 5s. TensorLake v2 has no documented long-poll or completion webhook.
+PARSE_POLL_SCHEDULE = (0.5, 1.0, 2.0, 4.0)
+PARSE_POLL_MAX_DELAY = 5.0
+PARSE_TIMEOUT = 120
+
+# Typed view of GET /parse/{id}; validated in one pass by pydantic-core instead of dict-walking
+class FragmentContent(BaseModel):
+    content: str = ""
+
+class PageFragment(BaseModel):
+    fragment_type: str | None = None
+    content: FragmentContent = FragmentContent()
+
+class ParsedPage(BaseModel):
+    page_fragments: list[PageFragment] = []
+
+class ParseResult(BaseModel):
+    status: str | None = None
+    pages: list[ParsedPage] = []
+    error: Any = None
+
 class TensorLakeV2RESTClient:
     """Simple REST client for TensorLake v2 API specifically for parsing."""
     def __init__(self):
@@ -15,6 +48,12 @@ class TensorLakeV2RESTClient:
         self.base_url = "https://api.tensorlake.ai/documents/v2"
         if not self.api_key:
             raise ValueError("TENSORLAKE_API_KEY not found in environment")
+        # Reuse TCP/TLS connections across the upload, parse and polling requests
+        self.session = requests.Session()
+        self.session.headers.update(self._headers())
+        # Retries transient gateway errors on idempotent calls (status polls); POSTs are not retried
+        retries = Retry(total=5, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries))
 
     def _headers(self):
         return {"Authorization": f"Bearer {self.api_key}"}
@@ -29,7 +68,7 @@ class TensorLakeV2RESTClient:
         url = f"{self.base_url}/files"
         print(f"  Uploading content ({len(content)} bytes)...")
         files = {"file": (filename, content, content_type)}
-        response = requests.post(url, headers=self._headers(), files=files, timeout=30)
+        response = self.session.post(url, files=files, timeout=30)
         print(f"  Upload response: {response.status_code}")
         response.raise_for_status()
         file_id = response.json().get("file_id")
@@ -47,53 +86,152 @@ class TensorLakeV2RESTClient:
         }
         
         print(f"  Requesting parse for {file_id}...")
-        response = requests.post(url, headers=self._headers(), json=payload, timeout=30)
+        response = self.session.post(url, json=payload, timeout=30)
         print(f"  Parse request response: {response.status_code}")
         response.raise_for_status()
         parse_id = response.json().get("parse_id")
         
         print(f"Waiting for parsing job {parse_id}...")
-        max_wait = 120 
-        while max_wait > 0:
-            result_url = f"{self.base_url}/parse/{parse_id}"
-            result_response = requests.get(result_url, headers=self._headers(), timeout=30)
+        started = time.monotonic()
+        deadline = started + PARSE_TIMEOUT
+        poll_delays = itertools.chain(PARSE_POLL_SCHEDULE, itertools.repeat(PARSE_POLL_MAX_DELAY))
+        result_url = f"{self.base_url}/parse/{parse_id}"
+        while time.monotonic() < deadline:
+            result_response = self.session.get(result_url, timeout=30)
             
             if result_response.status_code == 200:
-                data = result_response.json()
-                status = data.get("status")
-                print(f"  Parsing status: {status} (waited {120 - max_wait}s)")
+                data = ParseResult.model_validate_json(result_response.content)
+                status = data.status
+                print(f"  Parsing status: {status} (waited {time.monotonic() - started:.1f}s)")
                 
                 if status == "successful":
                     types_seen = set()
-                    for page in data.get("pages", []):
-                        for fragment in page.get("page_fragments", []):
-                            types_seen.add(fragment.get("fragment_type"))
-                    print(f"  Fragment types found: {types_seen}")
-                    
-                    full_md = ""
-                    for page in data.get("pages", []):
-                        for fragment in page.get("page_fragments", []):
-                            f_type = fragment.get("fragment_type")
-                            content = fragment.get("content", {}).get("content", "")
+                    parts: list[str] = []
+                    for page_index, page in enumerate(data.pages):
+                        if page_index:
+                            # Page boundaries let the extractor split very long statements
+                            parts.append(f"\n\n{PAGE_DELIMITER}\n\n")
+                        for fragment in page.page_fragments:
+                            f_type = fragment.fragment_type
+                            types_seen.add(f_type)
                             if f_type in ["text", "table", "list"]:
-                                full_md += f_type.upper() + ":\n" + content + "\n\n"
-                    return full_md
+                                parts.append(f"{f_type.upper()}:\n{fragment.content.content}\n\n")
+                    print(f"  Fragment types found: {types_seen}")
+                    return "".join(parts)
                 elif status in ["failed", "failure"]:
                     print(f"  Full response data: {data}")
-                    raise Exception(f"Parsing failed with status {status}: {data.get('error', 'No error message')}")
+                    raise Exception(f"Parsing failed with status {status}: {data.error or 'No error message'}")
             else:
                 print(f"  Warning: Polling status code {result_response.status_code}")
             
-            time.sleep(5)
-            max_wait -= 5
+            time.sleep(next(poll_delays))
         
         raise TimeoutError("Parsing job timed out")
 
+@functools.lru_cache(maxsize=1)
+def get_client() -> TensorLakeV2RESTClient:
+    """Process-wide client, so warm function invocations reuse its pooled connections."""
+    return TensorLakeV2RESTClient()
+
+# Upper bound on the combined markdown sent in one batched extraction call.
+# Gemini 2.5 Flash accepts far more input, but the JSON output for every
+# statement in the batch must fit in a single response, so stay conservative.
+BATCH_CHAR_BUDGET = int(0.8 * 100_000)
+BATCH_MAX_FILES = 8
+
+# Upload/parse is pure network wait on TensorLake, so overlap several files.
+INGEST_PARALLELISM = int(os.getenv("INGEST_PARALLELISM", "8"))
+# Parsed statements waiting for extraction; parse workers block once this many are queued
+PARSE_QUEUE_SIZE = 4
+_PARSE_DONE = object()
+# Write each parsed statement's Markdown to debug_<name>.md; off by default
+DEBUG_MARKDOWN = os.getenv("DEBUG_MARKDOWN") == "1"
+
+def _extract_batch_with_retry(markdowns):
+    """Runs a batched extraction, backing off on Gemini rate limits (RESOURCE_EXHAUSTED)."""
+    max_retries = 3
+    retry_delay = 30 # Longer delay for free tier
+
+    for attempt in range(max_retries):
+        try:
+            return extract_transactions_batch(markdowns)
+        except Exception as e:
+            if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
+                # Jitter the backoff so concurrent runs don't retry against the quota in lockstep
+                delay = retry_delay * random.uniform(0.5, 1.5)
+                print(f"  Rate limited (429/RESOURCE_EXHAUSTED). Retrying in {delay:.0f}s... (Attempt {attempt + 1}/{max_retries})")
+                time.sleep(delay)
+                retry_delay *= 2
+            else:
+                raise e
+    return None
+
+def _flush_batch(batch) -> int:
+    """
+    Extracts a batch of (filename, markdown) pairs in one call and saves every file's
+    transactions in one transaction, so memory stays bounded by a batch and earlier batches
+    are kept if a later one fails. Returns the number of new transactions saved.
+    """
+    if not batch:
+        return 0
+    filenames = [filename for filename, _ in batch]
+    print(f"\nExtracting transactions for {len(batch)} statement(s) using Gemini Agent: {', '.join(filenames)}")
+
+    try:
+        results = _extract_batch_with_retry([markdown for _, markdown in batch])
+    except Exception as e:
+        print(f"Batch extraction error for {filenames}: {e}")
+        traceback.print_exc()
+        return 0
+
+    if results is None:
+        print(f"Giving up on {filenames} after repeated rate limiting.")
+        return 0
+
+    pending = []
+
+    for filename, result in zip(filenames, results):
+        if result and result.transactions:
+            for tx in result.transactions:
+                tx.source_file = filename
+
+            pending.extend(result.transactions)
+            print(f"[{filename}] Successfully extracted {len(result.transactions)} transactions.")
+        else:
+            print(f"[{filename}] No transactions extracted for {filename}.")
+
+    new_count = save_transactions(pending)
+    if pending:
+        print(f"Saved {new_count} new transactions ({len(pending) - new_count} duplicates skipped).")
+    return new_count
+
+def _parse_one(client, file_path):
+    """Uploads a single statement and waits for its Markdown."""
+    filename = os.path.basename(file_path)
+    print(f"[{filename}] Uploading and parsing...")
+    file_id = client.upload(file_path)
+    return client.parse_to_markdown(file_id)
+
+def _produce_markdown(client, statement_files, parse_q):
+    """Producer stage: parses statements concurrently and feeds (filename, markdown) into parse_q."""
+    def _parse_into_queue(file_path):
+        filename = os.path.basename(file_path)
+        try:
+            markdown = _parse_one(client, file_path)
+        except Exception as e:
+            print(f"[{filename}] Error: {e}")
+            traceback.print_exc()
+            return
+        parse_q.put((filename, markdown))
+
+    try:
+        with ThreadPoolExecutor(max_workers=INGEST_PARALLELISM) as executor:
+            list(executor.map(_parse_into_queue, statement_files))
+    finally:
+        parse_q.put(_PARSE_DONE)
+
 def process_statements():
     print("--- Expense Explorer Ingestion Pipeline (Gemini-Powered) ---")
-    init_db()
-    client = TensorLakeV2RESTClient()
-    
     statement_dir = os.path.expanduser("~/Downloads/Credit_Card_Statements")
     statement_files = glob.glob(os.path.join(statement_dir, "*.pdf"))
     
@@ -101,56 +239,54 @@ def process_statements():
         print(f"No PDF statements found in {statement_dir}")
         return
 
-    for file_path in statement_files:
-        filename = os.path.basename(file_path)
-        print(f"\nProcessing {filename}...")
-        
-        try:
-            # 1. Parse to Markdown
-            print(f"[{filename}] Uploading and parsing...")
-            file_id = client.upload(file_path)
-            markdown = client.parse_to_markdown(file_id)
-            print(f"[{filename}] Received Markdown (length: {len(markdown)})")
-            with open("debug_statement.md", "w") as f:
+    ingest_many(statement_files)
+
+def ingest_many(statement_files: list[str]) -> int:
+    """
+    Parses, extracts and saves the given PDF statements, overlapping the stages across files.
+    Returns the number of new transactions saved.
+    """
+    init_db()
+    client = get_client()
+
+    # 1. Parse to Markdown on a producer thread while this thread extracts and saves,
+    # so steady-state throughput is bounded by the slower stage rather than their sum
+    parse_q = queue.Queue(maxsize=PARSE_QUEUE_SIZE)
+    producer = threading.Thread(target=_produce_markdown, args=(client, statement_files, parse_q), name="statement-parser", daemon=True)
+    producer.start()
+
+    batch = []
+    batch_chars = 0
+    new_count = 0
+
+    while True:
+        item = parse_q.get()
+        if item is _PARSE_DONE:
+            break
+        filename, markdown = item
+
+        print(f"[{filename}] Received Markdown (length: {len(markdown)})")
+        if DEBUG_MARKDOWN:
+            # One file per statement; parse workers finish in any order
+            debug_path = f"debug_{os.path.splitext(filename)[0]}.md"
+            with open(debug_path, "w") as f:
                 f.write(markdown)
-            print(f"[{filename}] Saved Markdown to debug_statement.md")
-            if len(markdown) < 100:
-                print(f"[{filename}] WARNING: Markdown looks too short:\n{markdown}")
-            
-            # 2. Extract using Gemini
-            print(f"[{filename}] Extracting transactions using Gemini Agent...")
-            
-            # Add retry logic for Gemini rate limits (RESOURCE_EXHAUSTED)
-            max_retries = 3
-            retry_delay = 30 # Longer delay for free tier
-            result = None
-            
-            for attempt in range(max_retries):
-                try:
-                    result = extract_transactions_agent(markdown)
-                    break 
-                except Exception as e:
-                    if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-                        print(f"  Rate limited (429/RESOURCE_EXHAUSTED). Retrying in {retry_delay}s... (Attempt {attempt + 1}/{max_retries})")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
-                    else:
-                        raise e
-            
-            # 3. Save
-            if result and result.transactions:
-                for tx in result.transactions:
-                    tx.source_file = filename
-                
-                save_transactions(result.transactions)
-                print(f"[{filename}] Successfully extracted and saved {len(result.transactions)} transactions.")
-            else:
-                print(f"[{filename}] No transactions extracted for {filename}.")
-                
-        except Exception as e:
-            import traceback
-            print(f"[{filename}] Error: {e}")
-            traceback.print_exc()
+            print(f"[{filename}] Saved Markdown to {debug_path}")
+        if not has_statement_content(markdown):
+            print(f"[{filename}] WARNING: Markdown looks too short or has no digits, skipping extraction:\n{markdown}")
+            continue
+
+        # 2. Extract using Gemini, several statements per call
+        if batch and (batch_chars + len(markdown) > BATCH_CHAR_BUDGET or len(batch) >= BATCH_MAX_FILES):
+            new_count += _flush_batch(batch)
+            batch, batch_chars = [], 0
+        batch.append((filename, markdown))
+        batch_chars += len(markdown)
+
+    # 3. Extract and save whatever is left over
+    new_count += _flush_batch(batch)
+    producer.join()
+    return new_count
 
 if __name__ == "__main__":
     process_statements()
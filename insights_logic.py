@@ -2,54 +2,99 @@
 Insights Logic for Expense Explorer.
 Contains the agent tools and CRUD functions for generating and storing insights.
 """
-import os
+import re
 import json
+import time
+import asyncio
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from typing import List, Dict, Any, Optional, Tuple
+from sqlalchemy import select, text
+from sqlalchemy.engine import Connection
 from sqlalchemy.exc import SQLAlchemyError
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import litellm
+import numpy as np
+import pandas as pd
 
-# Database setup
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    DATABASE_URL = "sqlite:///expenses.db"
-
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Share schema's engine (and its connection pool) rather than opening a second one
+from schema import engine
 
 # Cache duration: 1 week
 INSIGHTS_TTL_DAYS = 7
+_INSIGHTS_TTL = timedelta(days=INSIGHTS_TTL_DAYS)
+# In-process copy of the cached insights, so repeat reads skip the session + JSON decode.
+# Kept short because other workers can refresh the table underneath us.
+INSIGHTS_MEMO_TTL_SECONDS = 300
+_INSIGHTS_MEMO: Dict[str, Any] = {}
 
 
 def init_insights_table():
     """Creates the insights table if it doesn't exist."""
-    from schema import Base, engine
+    from schema import Base
     
     # Create all tables (including insights table via DBInsight model)
     Base.metadata.create_all(bind=engine)
 
 
+@contextmanager
+def _connect(conn: Optional[Connection] = None):
+    """Yields the caller's connection if given, otherwise a fresh one for this call."""
+    if conn is not None:
+        yield conn
+    else:
+        with engine.connect() as own_conn:
+            yield own_conn
+
+
 # ============================================================
 # TOOL 1: Category Summarizer (Pure SQL/Python)
 # ============================================================
 
-def summarize_by_category() -> Dict[str, float]:
-    """
-    Aggregates spending totals by category.
-    Returns a dict like {"Groceries": 450.00, "Travel": 1200.00, ...}
-    """
-    with engine.connect() as conn:
-        result = conn.execute(text("""
-            SELECT category, SUM(amount) as total
+# Category totals serialized to a JSON object by the database, largest first. Amounts
+# are summed as integer cents so totals carry no accumulated float error. Postgres orders
+# inside the aggregate; SQLite's json_group_object makes no ordering promise (ORDER BY in
+# the aggregate needs 3.44+), so summarize_by_category_json sorts its output.
+_CATEGORY_SUMMARY_SQL = {
+    "sqlite": text("""
+        SELECT json_group_object(category, total)
+        FROM (
+            SELECT category, SUM(CAST(ROUND(amount * 100) AS INTEGER)) / 100.0 AS total
             FROM transactions
             WHERE category IS NOT NULL
             GROUP BY category
             ORDER BY total DESC
-        """))
-        return {row[0]: round(float(row[1]), 2) for row in result}
+        )
+    """),
+    "postgresql": text("""
+        SELECT COALESCE(json_object_agg(category, total ORDER BY total DESC), '{}'::json)::text
+        FROM (
+            SELECT category, ROUND(SUM(ROUND(amount * 100)::bigint) / 100.0, 2) AS total
+            FROM transactions
+            WHERE category IS NOT NULL
+            GROUP BY category
+        ) totals
+    """),
+}
+
+def summarize_by_category_json(conn: Optional[Connection] = None) -> str:
+    """Category totals as a ready-to-store JSON string, built by the database."""
+    with _connect(conn) as conn:
+        summary_json = conn.execute(_CATEGORY_SUMMARY_SQL[conn.dialect.name]).scalar() or "{}"
+        if conn.dialect.name == "postgresql":
+            return summary_json
+    # A handful of categories, so re-sorting costs nothing next to the query
+    totals = json.loads(summary_json)
+    return json.dumps(dict(sorted(totals.items(), key=lambda item: item[1], reverse=True)))
+
+def summarize_by_category(conn: Optional[Connection] = None) -> Dict[str, float]:
+    """
+    Aggregates spending totals by category.
+    Returns a dict like {"Groceries": 450.00, "Travel": 1200.00, ...}
+    """
+    return json.loads(summarize_by_category_json(conn))
 
 
 # ============================================================
@@ -75,6 +120,21 @@ MERCHANT_RULES = {
     "Shopping": ["AMAZON", "TARGET", "BEST BUY", "APPLE STORE", "NORDSTROM", "MACYS"],
 }
 
+# All rules as one regex scan. The lookahead reports a match at every position, and the
+# alternation lists keywords in rule order, so the lowest-ranked hit is the same
+# (category, keyword) the rules would pick when checked one by one.
+_MERCHANT_KEYWORDS = [(category, keyword) for category, keywords in MERCHANT_RULES.items() for keyword in keywords]
+_MERCHANT_KEYWORD_RANK = {}
+for _rank, (_, _keyword) in enumerate(_MERCHANT_KEYWORDS):
+    _MERCHANT_KEYWORD_RANK.setdefault(_keyword, _rank)
+_MERCHANT_RE = re.compile("(?=(" + "|".join(re.escape(keyword) for _, keyword in _MERCHANT_KEYWORDS) + "))")
+
+@functools.lru_cache(maxsize=50_000)
+def _match_merchant_rule(upper_name: str) -> Optional[Tuple[str, str]]:
+    """(category, keyword) of the highest-priority rule in `upper_name`; cached, misses included."""
+    ranks = [_MERCHANT_KEYWORD_RANK[m.group(1)] for m in _MERCHANT_RE.finditer(upper_name)]
+    return _MERCHANT_KEYWORDS[min(ranks)] if ranks else None
+
 def enrich_merchant(merchant_name: str) -> Dict[str, Any]:
     """
     Enriches merchant with inferred business type and category.
@@ -83,16 +143,14 @@ def enrich_merchant(merchant_name: str) -> Dict[str, Any]:
     if not merchant_name:
         return {"type": "Unknown", "inferred_category": "Miscellaneous"}
     
-    upper_name = merchant_name.upper()
-    
-    for category, keywords in MERCHANT_RULES.items():
-        for keyword in keywords:
-            if keyword in upper_name:
-                return {
-                    "type": category,
-                    "inferred_category": category,
-                    "matched_keyword": keyword
-                }
+    match = _match_merchant_rule(merchant_name.upper())
+    if match:
+        category, keyword = match
+        return {
+            "type": category,
+            "inferred_category": category,
+            "matched_keyword": keyword
+        }
     
     return {"type": "Unknown", "inferred_category": "Miscellaneous"}
 
@@ -101,120 +159,170 @@ def enrich_merchant(merchant_name: str) -> Dict[str, Any]:
 # TOOL 3: Subscription Detector (Pattern Matching)
 # ============================================================
 
-def detect_subscriptions() -> List[Dict[str, Any]]:
+SUBSCRIPTION_KEYWORDS = ["SUBSCRIPTION", "MONTHLY", "NETFLIX", "SPOTIFY", "APPLE", "AMAZON PRIME", "HULU", "HBO", "DISNEY", "YOUTUBE", "INSURANCE"]
+
+# The keyword flag is computed by the database, so only candidate groups are returned
+_SUBSCRIPTION_MATCH = " OR ".join(f"UPPER(description) LIKE :kw{i}" for i in range(len(SUBSCRIPTION_KEYWORDS)))
+_SUBSCRIPTION_PARAMS = {f"kw{i}": f"%{kw}%" for i, kw in enumerate(SUBSCRIPTION_KEYWORDS)}
+_SUBSCRIPTION_SQL = text(f"""
+    SELECT description, amount, provider_name, account_last_4, COUNT(*) as occurrences,
+           CASE WHEN {_SUBSCRIPTION_MATCH} THEN 1 ELSE 0 END AS is_likely_subscription
+    FROM transactions
+    GROUP BY description, amount, provider_name, account_last_4
+    HAVING COUNT(*) >= 3 OR (COUNT(*) >= 2 AND ({_SUBSCRIPTION_MATCH}))
+    ORDER BY occurrences DESC
+""")
+
+def detect_subscriptions(conn: Optional[Connection] = None) -> List[Dict[str, Any]]:
     """
     Finds recurring transactions by matching:
     - Same merchant (or similar description)
     - Same amount (within 5% tolerance)
     - Regular interval (monthly)
     """
-    with engine.connect() as conn:
-        # Get all transactions grouped by description, amount, and account/provider
-        result = conn.execute(text("""
-            SELECT description, amount, provider_name, account_last_4, COUNT(*) as occurrences
-            FROM transactions
-            GROUP BY description, amount, provider_name, account_last_4
-            HAVING COUNT(*) >= 2
-            ORDER BY occurrences DESC
-        """))
-        
-        subscriptions = []
-        for row in result:
-            description, amount, provider_name, account_last_4, occurrences = row
-            
-            # Check if it matches known subscription keywords
-            upper_desc = description.upper() if description else ""
-            is_likely_subscription = any(
-                kw in upper_desc for kw in 
-                ["SUBSCRIPTION", "MONTHLY", "NETFLIX", "SPOTIFY", "APPLE", "AMAZON PRIME", "HULU", "HBO", "DISNEY", "YOUTUBE", "INSURANCE"]
-            )
-            
-            if is_likely_subscription or occurrences >= 3:
-                subscriptions.append({
-                    "description": description,
-                    "amount": float(amount),
-                    "occurrences": occurrences,
-                    "provider": provider_name,
-                    "account": account_last_4,
-                    "is_likely_subscription": is_likely_subscription,
-                    "estimated_monthly_cost": float(amount) if occurrences >= 2 else 0
-                })
+    with _connect(conn) as conn:
+        # Groups of identical charges that repeat 3+ times, or twice with a subscription keyword
+        result = conn.execute(_SUBSCRIPTION_SQL, _SUBSCRIPTION_PARAMS)
         
-        return subscriptions
+        return [
+            {
+                "description": description,
+                "amount": float(amount),
+                "occurrences": occurrences,
+                "provider": provider_name,
+                "account": account_last_4,
+                "is_likely_subscription": bool(is_likely_subscription),
+                "estimated_monthly_cost": float(amount) if occurrences >= 2 else 0
+            }
+            for description, amount, provider_name, account_last_4, occurrences, is_likely_subscription in result
+        ]
 
 
 # ============================================================
 # TOOL 3.5: Anomaly Detector (Statistics)
 # ============================================================
 
-def detect_anomalies() -> List[Dict[str, Any]]:
+# Chronological scan done by the database: a rolling mean of the previous 10 expenses in
+# each category, and a running count of distinct merchants seen before each row (every
+# merchant's first row adds one). Only the 5 latest candidate rows come back.
+_ANOMALY_SQL = text("""
+    WITH expenses AS (
+        SELECT id, date, amount, category, merchant, description,
+               LOWER(COALESCE(NULLIF(merchant, ''), description)) AS merchant_key
+        FROM transactions
+        WHERE amount > 0
+          AND COALESCE(category, '') NOT IN ('Credit Card Payment', 'Internal Transfer')
+    ),
+    windowed AS (
+        SELECT *,
+               AVG(amount) OVER (
+                   PARTITION BY category ORDER BY date, id
+                   ROWS BETWEEN 10 PRECEDING AND 1 PRECEDING
+               ) AS avg_prev,
+               ROW_NUMBER() OVER (PARTITION BY merchant_key ORDER BY date, id) AS merchant_seq
+        FROM expenses
+    ),
+    ranked AS (
+        SELECT *,
+               COALESCE(SUM(CASE WHEN merchant_seq = 1 THEN 1 ELSE 0 END) OVER (
+                   ORDER BY date, id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+               ), 0) AS merchants_seen
+        FROM windowed
+    )
+    SELECT date, amount, category, merchant, description, avg_prev,
+           (merchant_seq = 1 AND merchants_seen > 20) AS is_new_merchant
+    FROM ranked
+    WHERE (amount > 50 AND amount > avg_prev * 2.5)
+       OR (merchant_seq = 1 AND merchants_seen > 20)
+    ORDER BY date DESC, id DESC
+    LIMIT 5
+""")
+
+def detect_anomalies(conn: Optional[Connection] = None) -> List[Dict[str, Any]]:
     """
     Identifies:
     - Spending spikes (amount > 2x recent category average)
     - New merchant charges (first time seen)
     """
-    from schema import SessionLocal as SchemaSession, DBTransaction
-    from collections import defaultdict
-    import numpy as np
-
-    session = SchemaSession()
-    try:
-        transactions = session.query(DBTransaction).all()
-        if not transactions:
-            return []
-
-        # Sort by date
-        sorted_txs = sorted(transactions, key=lambda x: x.date)
-        
-        category_spending = defaultdict(list)
-        seen_merchants = set()
-        anomalies = []
-
-        # Process chronologically
-        for tx in sorted_txs:
-            # Skip non-expenses
-            if tx.amount <= 0 or tx.category in ["Credit Card Payment", "Internal Transfer"]:
-                continue
-
-            # 1. Spike Detection
-            recent_spending = category_spending[tx.category][-10:] # Last 10 in category
-            if recent_spending:
-                avg = sum(recent_spending) / len(recent_spending)
-                if tx.amount > (avg * 2.5) and tx.amount > 50:
-                    anomalies.append({
-                        "type": "spike",
-                        "severity": "high" if tx.amount > (avg * 5) else "medium",
-                        "description": f"Unusually high {tx.category} expense",
-                        "amount": tx.amount,
-                        "date": tx.date,
-                        "merchant": tx.merchant or tx.description
-                    })
-            
-            # 2. New Merchant Detection
-            m_key = (tx.merchant or tx.description).lower()
-            if m_key not in seen_merchants and len(seen_merchants) > 20: 
-                anomalies.append({
-                    "type": "new_merchant",
-                    "severity": "low",
-                    "description": f"First time spending at {tx.merchant or tx.description}",
-                    "amount": tx.amount,
-                    "date": tx.date,
-                    "merchant": tx.merchant or tx.description
-                })
-            
-            # Update state
-            category_spending[tx.category].append(tx.amount)
-            seen_merchants.add(m_key)
-
-        # Return latest anomalies (last 5)
-        return anomalies[-5:]
-    finally:
-        session.close()
+    with _connect(conn) as conn:
+        rows = conn.execute(_ANOMALY_SQL).fetchall()
+
+    anomalies = []
+    # Rows arrive newest first; each can yield a spike and a new-merchant anomaly
+    for date, amount, category, merchant, description, avg_prev, is_new_merchant in reversed(rows):
+        display_merchant = merchant or description
+
+        # 1. Spike Detection
+        if avg_prev is not None and amount > (avg_prev * 2.5) and amount > 50:
+            anomalies.append({
+                "type": "spike",
+                "severity": "high" if amount > (avg_prev * 5) else "medium",
+                "description": f"Unusually high {category} expense",
+                "amount": amount,
+                "date": date,
+                "merchant": display_merchant
+            })
+
+        # 2. New Merchant Detection
+        if is_new_merchant:
+            anomalies.append({
+                "type": "new_merchant",
+                "severity": "low",
+                "description": f"First time spending at {display_merchant}",
+                "amount": amount,
+                "date": date,
+                "merchant": display_merchant
+            })
+
+    # Return latest anomalies (last 5)
+    return anomalies[-5:]
 
 # ============================================================
 # TOOL 4: Category Inferer (LLM-Powered)
 # ============================================================
 
+CATEGORY_MODEL = "gemini/gemini-2.5-flash"
+# Concurrent completions in flight during infer_categories
+CATEGORY_CONCURRENCY = 8
+
+# Static instructions first and the description last, so every request shares a prefix
+_CATEGORY_PROMPT_PREFIX = """Categorize this transaction into ONE of these categories:
+Groceries, Dining, Transportation, Travel, Shopping, Subscriptions, Utilities, Insurance, Healthcare, Entertainment, Education, Personal Care, Miscellaneous
+
+Reply with ONLY the category name, nothing else.
+
+Transaction: """
+
+# One Router for the process: provider config is resolved once and HTTP clients are reused
+_CATEGORY_ROUTER = litellm.Router(model_list=[{"model_name": CATEGORY_MODEL, "litellm_params": {"model": CATEGORY_MODEL}}])
+
+# Inferred categories keyed by normalized description, so repeat merchants skip the LLM.
+# Least recently used entries are evicted first, so a warm container's cache stays bounded.
+INFERRED_CATEGORY_CACHE_SIZE = 4096
+_inferred_categories: "OrderedDict[str, str]" = OrderedDict()
+
+def _recall_category(key: str) -> Optional[str]:
+    category = _inferred_categories.get(key)
+    if category is not None:
+        _inferred_categories.move_to_end(key)
+    return category
+
+def _remember_category(key: str, category: str) -> None:
+    _inferred_categories[key] = category
+    _inferred_categories.move_to_end(key)
+    while len(_inferred_categories) > INFERRED_CATEGORY_CACHE_SIZE:
+        _inferred_categories.popitem(last=False)
+
+def _category_key(description: str) -> str:
+    return " ".join(description.upper().split())
+
+def _category_request(description: str) -> Dict[str, Any]:
+    return {
+        "model": CATEGORY_MODEL,
+        "messages": [{"role": "user", "content": _CATEGORY_PROMPT_PREFIX + description}],
+        "max_tokens": 20
+    }
+
 def infer_category(description: str) -> str:
     """
     Uses Gemini to intelligently categorize a transaction.
@@ -222,235 +330,312 @@ def infer_category(description: str) -> str:
     """
     if not description:
         return "Miscellaneous"
+
+    key = _category_key(description)
+    cached = _recall_category(key)
+    if cached is not None:
+        return cached
     
     try:
-        response = litellm.completion(
-            model="gemini/gemini-2.5-flash",
-            messages=[{
-                "role": "user",
-                "content": f"""Categorize this transaction into ONE of these categories:
-Groceries, Dining, Transportation, Travel, Shopping, Subscriptions, Utilities, Insurance, Healthcare, Entertainment, Education, Personal Care, Miscellaneous
-
-Transaction: {description}
-
-Reply with ONLY the category name, nothing else."""
-            }],
-            max_tokens=20
-        )
+        response = _CATEGORY_ROUTER.completion(**_category_request(description))
         category = response.choices[0].message.content.strip()
-        return category if category else "Miscellaneous"
+        category = category if category else "Miscellaneous"
     except Exception as e:
         print(f"LLM inference error: {e}")
         return "Miscellaneous"
+    _remember_category(key, category)
+    return category
+
+
+async def infer_categories(descriptions: List[str]) -> List[str]:
+    """
+    Categorizes many transactions concurrently, one completion per distinct description.
+    Returns categories in the same order as `descriptions`.
+    """
+    semaphore = asyncio.Semaphore(CATEGORY_CONCURRENCY)
+
+    async def _infer_one(description: str) -> Optional[str]:
+        async with semaphore:
+            try:
+                response = await _CATEGORY_ROUTER.acompletion(**_category_request(description))
+                # content is None for filtered or truncated responses; treat like any other failure
+                category = response.choices[0].message.content.strip()
+            except Exception as e:
+                print(f"LLM inference error: {e}")
+                return None
+        return category if category else "Miscellaneous"
+
+    unique = {}
+    for description in descriptions:
+        if description:
+            unique.setdefault(_category_key(description), description)
+    # Resolved locally too, so entries evicted mid-batch still reach the result
+    resolved = {}
+    for key in unique:
+        cached = _recall_category(key)
+        if cached is not None:
+            resolved[key] = cached
+    pending = [key for key in unique if key not in resolved]
+
+    results = await asyncio.gather(*[_infer_one(unique[key]) for key in pending])
+    for key, category in zip(pending, results):
+        # Failed lookups fall back to Miscellaneous below but are retried next time
+        if category is not None:
+            resolved[key] = category
+            _remember_category(key, category)
+
+    return [
+        resolved.get(_category_key(description), "Miscellaneous") if description else "Miscellaneous"
+        for description in descriptions
+    ]
 
 
 # ============================================================
 # TOOL 5: Trend Analyzer
 # ============================================================
 
-def analyze_trends() -> Dict[str, Any]:
+_EMPTY_TRENDS = {
+    "trend": "stable", "change_percentage": 0, "current_month_total": 0,
+    "previous_month_total": 0, "daily": [], "weekly": [], "monthly": []
+}
+# Date formats found in the database: YYYY-M-D, and MM/DD/YYYY falling back to DD/MM/YYYY
+_ISO_DATE_RE = r"^\s*(?P<year>\d{4})-(?P<month>\d+)-(?P<day>\d+)\s*$"
+_SLASH_DATE_RE = r"^\s*(?P<first>\d+)/(?P<second>\d+)/(?P<year>\d{4})\s*$"
+
+# Only the two columns the trend math uses, loaded column-wise. Transfers and payments
+# are skipped in SQL to avoid double-counting in spending trends.
+_TREND_ROWS_SQL = text("""
+    SELECT date, amount
+    FROM transactions
+    WHERE COALESCE(category, '') NOT IN ('Credit Card Payment', 'Internal Transfer')
+""")
+
+def _parse_statement_dates(dates: pd.Series) -> pd.Series:
+    """Vectorized parse of the mixed date strings; unparseable values become NaT."""
+    dates = dates.astype(str)
+    iso = dates.str.extract(_ISO_DATE_RE).astype(float)
+    slash = dates.str.extract(_SLASH_DATE_RE).astype(float)
+
+    iso_dt = pd.to_datetime(iso[["year", "month", "day"]], errors="coerce")
+    us_dt = pd.to_datetime(slash.rename(columns={"first": "month", "second": "day"})[["year", "month", "day"]], errors="coerce")
+    eu_dt = pd.to_datetime(slash.rename(columns={"first": "day", "second": "month"})[["year", "month", "day"]], errors="coerce")
+    return iso_dt.fillna(us_dt).fillna(eu_dt)
+
+def _bucket_totals(keys: np.ndarray, cents: np.ndarray):
+    """Sorted unique bucket keys and their totals, summed in integer cents and returned in dollars."""
+    buckets, inverse = np.unique(keys, return_inverse=True)
+    return buckets, np.bincount(inverse, weights=cents) / 100
+
+def analyze_trends(conn: Optional[Connection] = None) -> Dict[str, Any]:
     """
     Analyzes spending trends over time.
-    Aggregates in Python to be robust against varying date formats in the database.
+    Parses dates with pandas to be robust against varying date formats in the database.
     """
-    from schema import SessionLocal as SchemaSession, DBTransaction
-    from collections import defaultdict
-    from datetime import datetime, timedelta
-    import re
-
-    session = SchemaSession()
-    try:
-        transactions = session.query(DBTransaction).all()
-        if not transactions:
-            return {
-                "trend": "stable", "change_percentage": 0, "current_month_total": 0,
-                "previous_month_total": 0, "daily": [], "weekly": [], "monthly": []
-            }
-
-        parsed_data = []
-        for tx in transactions:
-            # Skip transfers and payments to avoid double-counting in spending trends
-            if tx.category in ["Credit Card Payment", "Internal Transfer"]:
-                continue
-                
-            try:
-                # Handle various formats: YYYY-MM-DD, MM/DD/YYYY, etc.
-                d_str = tx.date
-                dt = None
-                if '-' in d_str: # Assume YYYY-MM-DD or YYYY-M-D
-                    parts = d_str.split('-')
-                    if len(parts[0]) == 4:
-                        dt = datetime(int(parts[0]), int(parts[1]), int(parts[2]))
-                elif '/' in d_str: # Assume MM/DD/YYYY or DD/MM/YYYY
-                    parts = d_str.split('/')
-                    if len(parts[2]) == 4:
-                        # Guessing MM/DD/YYYY first
-                        try: dt = datetime(int(parts[2]), int(parts[0]), int(parts[1]))
-                        except: dt = datetime(int(parts[2]), int(parts[1]), int(parts[0]))
-                
-                if dt:
-                    parsed_data.append({"date": dt, "amount": tx.amount})
-            except Exception:
-                continue
-
-        if not parsed_data:
-            return {"trend": "stable", "change_percentage": 0, "current_month_total": 0, "previous_month_total": 0, "daily": [], "weekly": [], "monthly": []}
-
-        # Sort by date
-        parsed_data.sort(key=lambda x: x['date'])
-        anchor_date = parsed_data[-1]['date']
-
-        # Daily (last 30 days of data)
-        daily_map = defaultdict(float)
-        thirty_days_ago = anchor_date - timedelta(days=30)
-        for d in parsed_data:
-            if d['date'] >= thirty_days_ago:
-                date_key = d['date'].strftime('%Y-%m-%d')
-                daily_map[date_key] += d['amount']
-        daily_series = [{"date": k, "amount": round(v, 2)} for k, v in sorted(daily_map.items())]
-
-        # Monthly (all time, but focused on last 12)
-        monthly_map = defaultdict(float)
-        for d in parsed_data:
-            month_key = d['date'].strftime('%Y-%m')
-            monthly_map[month_key] += d['amount']
-        monthly_series = [{"month": k, "amount": round(v, 2)} for k, v in sorted(monthly_map.items())]
-        
-        # Weekly (last 12 weeks of data)
-        weekly_map = defaultdict(float)
-        twelve_weeks_ago = anchor_date - timedelta(weeks=12)
-        for d in parsed_data:
-            if d['date'] >= twelve_weeks_ago:
-                # ISO week format
-                week_key = d['date'].strftime('%Y-W%W')
-                weekly_map[week_key] += d['amount']
-        weekly_series = [{"week": k, "amount": round(v, 2)} for k, v in sorted(weekly_map.items())]
-
-        # Calculate Trend
-        change_pct = 0
-        current_val = 0
-        previous_val = 0
-        if len(monthly_series) >= 2:
-            current_val = monthly_series[-1]['amount']
-            previous_val = monthly_series[-2]['amount']
-            if previous_val != 0:
-                change_pct = ((current_val - previous_val) / abs(previous_val)) * 100
-        else:
-            current_val = monthly_series[0]['amount'] if monthly_series else 0
-
-        trend_direction = "increasing" if change_pct > 5 else "decreasing" if change_pct < -5 else "stable"
+    with _connect(conn) as conn:
+        df = pd.read_sql(_TREND_ROWS_SQL, conn)
+    if df.empty:
+        return dict(_EMPTY_TRENDS)
+
+    df = df.assign(
+        dt=_parse_statement_dates(df["date"]),
+        cents=(df["amount"] * 100).round().astype("int64")
+    ).dropna(subset=["dt"])
+    if df.empty:
+        return dict(_EMPTY_TRENDS)
+
+    # Integer bucket keys; only the unique buckets are formatted as strings
+    dt = df["dt"]
+    days = dt.values.astype("datetime64[D]")
+    cents = df["cents"].values
+    anchor_date = days.max()
+
+    # Daily (last 30 days of data)
+    recent = days >= anchor_date - np.timedelta64(30, "D")
+    buckets, totals = _bucket_totals(days[recent], cents[recent])
+    daily_series = [{"date": k, "amount": float(v)} for k, v in zip(np.datetime_as_string(buckets, unit="D"), totals)]
+
+    # Monthly (all time, but focused on last 12)
+    buckets, totals = _bucket_totals(days.astype("datetime64[M]"), cents)
+    monthly_series = [{"month": k, "amount": float(v)} for k, v in zip(np.datetime_as_string(buckets, unit="M"), totals)]
+
+    # Weekly (last 12 weeks of data), keyed like strftime('%Y-W%W'): Monday-based week of year
+    recent = days >= anchor_date - np.timedelta64(12 * 7, "D")
+    week_keys = (dt.dt.year * 100 + (dt.dt.dayofyear - 1 + 7 - dt.dt.dayofweek) // 7).values
+    buckets, totals = _bucket_totals(week_keys[recent], cents[recent])
+    weekly_series = [{"week": f"{k // 100}-W{k % 100:02d}", "amount": float(v)} for k, v in zip(buckets, totals)]
+
+    # Calculate Trend
+    change_pct = 0
+    current_val = 0
+    previous_val = 0
+    if len(monthly_series) >= 2:
+        current_val = monthly_series[-1]['amount']
+        previous_val = monthly_series[-2]['amount']
+        if previous_val != 0:
+            change_pct = ((current_val - previous_val) / abs(previous_val)) * 100
+    else:
+        current_val = monthly_series[0]['amount'] if monthly_series else 0
+
+    trend_direction = "increasing" if change_pct > 5 else "decreasing" if change_pct < -5 else "stable"
 
-        return {
-            "trend": trend_direction,
-            "change_percentage": round(change_pct, 1),
-            "current_month_total": round(current_val, 2),
-            "previous_month_total": round(previous_val, 2),
-            "daily": daily_series,
-            "weekly": weekly_series,
-            "monthly": monthly_series[-12:] # Last 12 months
-        }
-    finally:
-        session.close()
+    return {
+        "trend": trend_direction,
+        "change_percentage": round(change_pct, 1),
+        "current_month_total": round(current_val, 2),
+        "previous_month_total": round(previous_val, 2),
+        "daily": daily_series,
+        "weekly": weekly_series,
+        "monthly": monthly_series[-12:] # Last 12 months
+    }
 
 
 # ============================================================
 # INSIGHT PERSISTENCE
 # ============================================================
 
+def save_insight(insight_type: str, key: str, value: Any, transaction_ids: List[int] = None, confidence: float = 1.0, conn: Optional[Connection] = None) -> None:
+    """
+    Saves or updates an insight in the database.
+    Uses UPSERT logic based on (insight_type, key). When `conn` is given the write joins
+    the caller's transaction instead of committing on its own.
+    """
+    save_insights_bulk([{
+        "insight_type": insight_type,
+        "key": key,
+        "value": value,
+        "transaction_ids": transaction_ids,
+        "confidence": confidence
+    }], conn=conn)
+
+
+def save_insights_bulk(insights: List[Dict[str, Any]], conn: Optional[Connection] = None, computed_at: Optional[datetime] = None) -> None:
+    """
+    Upserts several insights in one executemany statement. Each dict takes the
+    save_insight arguments: insight_type, key, value and optionally transaction_ids, confidence.
+    `computed_at` defaults to now; every row shares it and the expiry derived from it.
+    When `conn` is given the caller must clear _INSIGHTS_MEMO once its transaction commits.
+    """
+    from schema import DBInsight, dialect_insert
+
+    if not insights:
+        return
+
+    now = computed_at or datetime.utcnow()
+    expires_at = now + _INSIGHTS_TTL
+    rows = [
+        {
+            "insight_type": insight["insight_type"],
+            "key": insight["key"],
+            "value": json.dumps(insight["value"]) if not isinstance(insight["value"], str) else insight["value"],
+            "transaction_ids": ",".join(map(str, insight["transaction_ids"])) if insight.get("transaction_ids") else None,
+            "confidence": insight.get("confidence", 1.0),
+            "computed_at": now,
+            "expires_at": expires_at
+        }
+        for insight in insights
+    ]
+
+    # INSERT ... ON CONFLICT (insight_type, key) DO UPDATE against _insight_type_key_uc
+    stmt = dialect_insert(DBInsight)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["insight_type", "key"],
+        set_={col: stmt.excluded[col] for col in ("value", "transaction_ids", "confidence", "computed_at", "expires_at")}
+    )
+    if conn is not None:
+        # The caller owns this transaction; after a failure Postgres has aborted it, so
+        # retrying here could never succeed. Leave retries to whoever owns the transaction.
+        conn.execute(stmt, rows)
+    else:
+        _execute_in_own_transaction(stmt, rows)
+        # Only after the commit; clearing earlier lets a concurrent reader re-memoize the old rows
+        _INSIGHTS_MEMO.clear()
+
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
     retry=retry_if_exception_type(SQLAlchemyError),
     reraise=True
 )
-def save_insight(insight_type: str, key: str, value: Any, transaction_ids: List[int] = None, confidence: float = 1.0) -> None:
-    """
-    Saves or updates an insight in the database.
-    Uses UPSERT logic based on (insight_type, key).
-    """
-    from schema import DBInsight, SessionLocal as SchemaSession
-    
-    session = SchemaSession()
-    try:
-        # Check for existing insight
-        existing = session.query(DBInsight).filter(
-            DBInsight.insight_type == insight_type,
-            DBInsight.key == key
-        ).first()
-        
-        value_json = json.dumps(value) if not isinstance(value, str) else value
-        expires_at = datetime.utcnow() + timedelta(days=INSIGHTS_TTL_DAYS)
-        tx_ids_str = ",".join(map(str, transaction_ids)) if transaction_ids else None
-        
-        if existing:
-            existing.value = value_json
-            existing.transaction_ids = tx_ids_str
-            existing.confidence = confidence
-            existing.computed_at = datetime.utcnow()
-            existing.expires_at = expires_at
-        else:
-            new_insight = DBInsight(
-                insight_type=insight_type,
-                key=key,
-                value=value_json,
-                transaction_ids=tx_ids_str,
-                confidence=confidence,
-                expires_at=expires_at
-            )
-            session.add(new_insight)
-        
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+def _execute_in_own_transaction(stmt, rows: List[Dict[str, Any]]) -> None:
+    """Runs an executemany in a fresh transaction, so each retry starts clean."""
+    with engine.begin() as conn:
+        conn.execute(stmt, rows)
+
+
+_WATERMARK_SQL = text("SELECT COALESCE(MAX(id), 0), COUNT(*) FROM transactions")
+
+def _transactions_watermark(conn: Connection) -> List[int]:
+    """[max id, row count] of transactions; changes whenever rows are added or removed."""
+    max_id, count = conn.execute(_WATERMARK_SQL).one()
+    return [max_id, count]
 
 
 def get_cached_insights() -> Optional[Dict[str, Any]]:
     """
-    Returns cached insights if they exist and are not expired.
+    Returns cached insights if the transactions they were computed from are unchanged
+    (or, for rows stored without a watermark, if they are not expired).
     Returns None if insights are stale or don't exist.
     """
-    from schema import DBInsight, SessionLocal as SchemaSession
-    
-    session = SchemaSession()
-    try:
-        now = datetime.utcnow()
-        insights = session.query(DBInsight).filter(
-            DBInsight.expires_at > now
+    from schema import DBInsight
+
+    now = datetime.utcnow()
+    with engine.connect() as conn:
+        # One indexed aggregate; checked before the memo so rows saved by ingest (which never
+        # touches the memo) invalidate it straight away
+        watermark = _transactions_watermark(conn)
+        memo = _INSIGHTS_MEMO.get("all")
+        if memo and memo[0] > time.monotonic() and memo[1] == watermark:
+            return memo[2]
+        rows = conn.execute(
+            select(DBInsight.insight_type, DBInsight.key, DBInsight.value, DBInsight.computed_at, DBInsight.expires_at)
         ).all()
-        
-        if not insights:
+
+    stored_watermark = next((json.loads(row.value) for row in rows if row.insight_type == "watermark"), None)
+    if stored_watermark is not None:
+        # Insights are a pure function of the transactions, so they hold until those change
+        if stored_watermark != watermark:
             return None
+        # Merchant enrichments are saved outside the watermarked pipeline, so they still expire
+        rows = [row for row in rows if row.insight_type != "merchant_enrichment" or row.expires_at > now]
+        enrichment_expiries = [row.expires_at for row in rows if row.insight_type == "merchant_enrichment"]
+        memo_seconds = INSIGHTS_MEMO_TTL_SECONDS
+        if enrichment_expiries:
+            memo_seconds = min(memo_seconds, (min(enrichment_expiries) - now).total_seconds())
+    else:
+        rows = [row for row in rows if row.expires_at > now]
+        if not rows:
+            return None
+        # Never serve the memo past the point where the first stored insight goes stale
+        seconds_to_expiry = (min(row.expires_at for row in rows) - now).total_seconds()
+        memo_seconds = min(INSIGHTS_MEMO_TTL_SECONDS, seconds_to_expiry)
+    
+    result = {
+        "category_summary": {},
+        "subscriptions": [],
+        "trends": {},
+        "anomalies": [],
+        "merchants": {},
+        "computed_at": None
+    }
+    
+    for insight_type, key, raw_value, computed_at, _ in rows:
+        value = json.loads(raw_value) if raw_value else None
         
-        result = {
-            "category_summary": {},
-            "subscriptions": [],
-            "trends": {},
-            "anomalies": [],
-            "merchants": {},
-            "computed_at": None
-        }
-        
-        for insight in insights:
-            value = json.loads(insight.value) if insight.value else None
-            
-            if insight.insight_type == "category_summary":
-                result["category_summary"] = value
-                result["computed_at"] = insight.computed_at.isoformat()
-            elif insight.insight_type == "subscriptions":
-                result["subscriptions"] = value
-            elif insight.insight_type == "trends":
-                result["trends"] = value
-            elif insight.insight_type == "merchant_enrichment":
-                result["merchants"][insight.key] = value
-            elif insight.insight_type == "anomalies":
-                result["anomalies"] = value
-        
-        return result
-    finally:
-        session.close()
+        if insight_type == "category_summary":
+            result["category_summary"] = value
+            result["computed_at"] = computed_at.isoformat()
+        elif insight_type == "subscriptions":
+            result["subscriptions"] = value
+        elif insight_type == "trends":
+            result["trends"] = value
+        elif insight_type == "merchant_enrichment":
+            result["merchants"][key] = value
+        elif insight_type == "anomalies":
+            result["anomalies"] = value
+
+    _INSIGHTS_MEMO["all"] = (time.monotonic() + memo_seconds, watermark, result)
+    return result
 
 
 def run_full_insights_pipeline(force_refresh: bool = False) -> Dict[str, Any]:
@@ -464,22 +649,38 @@ def run_full_insights_pipeline(force_refresh: bool = False) -> Dict[str, Any]:
         if cached:
             return cached
     
-    # Run all tools
-    print("Running category summarizer...")
-    category_summary = summarize_by_category()
-    save_insight("category_summary", "all", category_summary)
-    
-    print("Detecting subscriptions...")
-    subscriptions = detect_subscriptions()
-    save_insight("subscriptions", "all", subscriptions)
-    
-    print("Analyzing trends...")
-    trends = analyze_trends()
-    save_insight("trends", "all", trends)
-    
-    print("Detecting anomalies...")
-    anomalies = detect_anomalies()
-    save_insight("anomalies", "all", anomalies)
+    # One timestamp for the whole run, shared by every stored insight and the response
+    now = datetime.utcnow()
+
+    # Run all tools on one connection and upsert every insight in one statement
+    with engine.begin() as conn:
+        # Read first, so rows landing mid-run leave the stored watermark behind and force a recompute
+        watermark = _transactions_watermark(conn)
+
+        print("Running category summarizer...")
+        # Stored verbatim; save_insights_bulk skips json.dumps for strings
+        category_summary_json = summarize_by_category_json(conn)
+        category_summary = json.loads(category_summary_json)
+        
+        print("Detecting subscriptions...")
+        subscriptions = detect_subscriptions(conn)
+        
+        print("Analyzing trends...")
+        trends = analyze_trends(conn)
+        
+        print("Detecting anomalies...")
+        anomalies = detect_anomalies(conn)
+
+        save_insights_bulk([
+            {"insight_type": "category_summary", "key": "all", "value": category_summary_json},
+            {"insight_type": "subscriptions", "key": "all", "value": subscriptions},
+            {"insight_type": "trends", "key": "all", "value": trends},
+            {"insight_type": "anomalies", "key": "all", "value": anomalies},
+            {"insight_type": "watermark", "key": "all", "value": watermark},
+        ], conn=conn, computed_at=now)
+    # Committed; drop the memo now rather than inside the transaction, where a concurrent
+    # get_cached_insights could re-memoize the rows being replaced
+    _INSIGHTS_MEMO.clear()
     
     print("Insights pipeline complete!")
     
@@ -488,5 +689,5 @@ def run_full_insights_pipeline(force_refresh: bool = False) -> Dict[str, Any]:
         "subscriptions": subscriptions,
         "trends": trends,
         "anomalies": anomalies,
-        "computed_at": datetime.utcnow().isoformat()
+        "computed_at": now.isoformat()
     }
@@ -1,19 +1,77 @@
 import os
 import io
+import ast
+import builtins
 import contextlib
+import functools
+import threading
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional
 import asyncio
 import pandas as pd
 import numpy as np
+try:
+    import polars as pl
+except ImportError:  # optional; execute_python then offers pandas only
+    pl = None
 from google.adk.agents.llm_agent import Agent
 from google.adk.runners import InMemoryRunner
+from google.adk.utils.context_utils import Aclosing
 from google.genai import types
-from sqlalchemy import text
-from schema import SessionLocal, init_db
+from sqlalchemy import func, select, text
+from schema import DBTransaction, SessionLocal, engine, init_db
 
 # Ensure API keys are accessible
 if not os.getenv("GOOGLE_API_KEY") and os.getenv("GEMINI_API_KEY"):
     os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
 
+# One long-lived loop on a daemon thread runs every agent call, instead of patching
+# whichever loop the caller happens to have with nest_asyncio
+_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, name="query-agent-event-loop", daemon=True).start()
+
+# Typed query results handed from execute_sql to execute_python by id, so full result
+# sets never round-trip through the model as CSV. Oldest entries are evicted first, both by
+# count and by total (shallow) frame memory; a single frame over the byte cap is not kept at all.
+RESULT_PREVIEW_ROWS = 50
+RESULT_STORE_SIZE = 32
+RESULT_STORE_MAX_BYTES = 256 * 1024 * 1024
+SQL_FETCH_CHUNK_ROWS = 10_000
+_RESULT_STORE: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+
+def _frame_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=False).sum())
+
+def _store_result(df: pd.DataFrame) -> Optional[str]:
+    """Keeps df for execute_python and returns its id, or None if it is over the byte cap on its own."""
+    size = _frame_bytes(df)
+    if size > RESULT_STORE_MAX_BYTES:
+        return None
+    result_id = uuid.uuid4().hex[:12]
+    _RESULT_STORE[result_id] = df
+    total = sum(_frame_bytes(stored) for stored in _RESULT_STORE.values())
+    while len(_RESULT_STORE) > RESULT_STORE_SIZE or total > RESULT_STORE_MAX_BYTES:
+        _, evicted = _RESULT_STORE.popitem(last=False)
+        total -= _frame_bytes(evicted)
+    return result_id
+
+def _format_result(df: pd.DataFrame) -> str:
+    """Tool response for a query result: its result_id, row count and a CSV preview."""
+    if df.empty:
+        return "Query executed successfully, but returned no results."
+    result_id = _store_result(df)
+    if result_id is None:
+        header = f"rows: {len(df)}\n(result too large to keep for execute_python; filter or aggregate in SQL instead)\n"
+    else:
+        header = f"result_id: {result_id}\nrows: {len(df)}\n"
+        if len(df) > RESULT_PREVIEW_ROWS:
+            header += f"(showing first {RESULT_PREVIEW_ROWS}; pass result_id to execute_python for all rows)\n"
+    return header + df.head(RESULT_PREVIEW_ROWS).to_csv(index=False)
+
+# Aggregates the agent may request through DatabaseExplorer.aggregate
+_AGGREGATES = {"sum": func.sum, "avg": func.avg, "count": func.count, "min": func.min, "max": func.max}
+
 class DatabaseExplorer:
     """Tool to execute SQL queries and explore database schema."""
     
@@ -29,112 +87,287 @@ class DatabaseExplorer:
 
     def execute_sql(self, sql: str) -> str:
         """
-        Executes a read-only SQL query against the database and returns results as CSV string.
+        Executes a read-only SQL query against the database.
+        Returns a result_id for execute_python plus the rows as CSV (only the first rows for large results).
         Only SELECT statements are allowed.
         """
         print(f"DEBUG: DatabaseExplorer executing SQL: {sql}")
         if not sql.strip().lower().startswith("select"):
             return "Error: Only SELECT queries are allowed."
             
-        session = SessionLocal()
         try:
-            result = session.execute(text(sql))
-            df = pd.DataFrame(result.fetchall(), columns=result.keys())
-            if df.empty:
-                return "Query executed successfully, but returned no results."
-            return df.to_csv(index=False)
+            # Stream the cursor in chunks rather than materializing a full row list and then copying it into a DataFrame
+            with engine.connect().execution_options(stream_results=True, yield_per=SQL_FETCH_CHUNK_ROWS) as conn:
+                chunks = list(pd.read_sql_query(text(sql), conn, chunksize=SQL_FETCH_CHUNK_ROWS))
+            df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+            return _format_result(df)
+        except Exception as e:
+            return f"SQL Error: {str(e)}"
+
+    def aggregate(self, group_by: List[str], metric: str = "amount", agg: str = "sum") -> str:
+        """
+        Aggregates the 'transactions' table in the database: SELECT group_by..., agg(metric) ... GROUP BY group_by.
+        'group_by' is a list of transaction column names (e.g. ["category"] or ["merchant"]),
+        'agg' is one of sum, avg, count, min, max. Prefer this over execute_python for plain summaries.
+        """
+        print(f"DEBUG: DatabaseExplorer aggregating {agg}({metric}) by {group_by}")
+        columns = DBTransaction.__table__.columns
+        unknown = [name for name in [*group_by, metric] if name not in columns]
+        if unknown:
+            return f"Error: unknown column(s) {unknown}. Valid columns: {', '.join(columns.keys())}"
+        if agg not in _AGGREGATES:
+            return f"Error: agg must be one of {', '.join(_AGGREGATES)}."
+
+        value = _AGGREGATES[agg](columns[metric]).label(f"{agg}_{metric}")
+        group_cols = [columns[name] for name in group_by]
+        stmt = select(*group_cols, value).group_by(*group_cols).order_by(value.desc())
+        try:
+            with SessionLocal() as session:
+                result = session.execute(stmt)
+                df = pd.DataFrame(result.fetchall(), columns=result.keys())
+            return _format_result(df)
         except Exception as e:
             return f"SQL Error: {str(e)}"
-        finally:
-            session.close()
+
+# Builtins a snippet may not name at all (calling, aliasing or passing them around alike);
+# pd, np and pl are preloaded so imports are never needed. The getattr family is included so
+# the attribute checks below can't be sidestepped by looking a method up by string.
+_FORBIDDEN_NAMES = frozenset({
+    "open", "exec", "eval", "compile", "__import__", "input", "breakpoint",
+    "getattr", "setattr", "delattr", "globals", "locals", "vars",
+})
+
+# pandas/NumPy/Polars methods that always read or write files: read_*/write_*/scan_*/sink_* by
+# prefix, plus the binary/database writers and NumPy's load/save family by name
+_FORBIDDEN_ATTR_PREFIXES = ("read_", "write_", "scan_", "sink_")
+_FORBIDDEN_ATTRS = frozenset({
+    "to_excel", "to_parquet", "to_pickle", "to_feather", "to_hdf", "to_sql", "to_stata", "to_orc", "to_clipboard",
+    "load", "save", "savez", "savez_compressed", "loadtxt", "savetxt", "genfromtxt", "fromfile", "tofile", "memmap",
+})
+# Text renderers that return a string when called without a destination (the usual way to
+# build a Markdown answer) and only write a file when given one, so they are checked per call
+_TEXT_OUTPUT_ATTRS = frozenset({
+    "to_csv", "to_json", "to_html", "to_latex", "to_xml", "to_markdown", "to_string",
+    "write_csv", "write_json", "write_ndjson",
+})
+_DESTINATION_KEYWORDS = frozenset({"path_or_buf", "path_or_buffer", "buf", "path", "file"})
+
+class _ToolCodeValidator(ast.NodeVisitor):
+    """
+    Rejects imports, open/exec/eval-style builtins (by name, in any context), dunder names and
+    attributes, and pandas/NumPy/Polars file I/O before anything runs. Text renderers such as
+    to_csv/to_markdown are allowed only when called directly with no path or buffer.
+    A guard against accidental misuse by the model, not a sandbox.
+    """
+
+    def __init__(self):
+        self._checked_renderers = set()
+
+    def visit_Import(self, node):
+        raise ValueError("imports are not allowed; pd, np and pl are already available")
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Name(self, node):
+        if node.id in _FORBIDDEN_NAMES:
+            raise ValueError(f"'{node.id}' is not allowed")
+        if node.id.startswith("__") and node.id.endswith("__"):
+            raise ValueError(f"access to '{node.id}' is not allowed")
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Attribute) and func.attr in _TEXT_OUTPUT_ATTRS:
+            # A positional argument, a destination keyword or **kwargs may name a file
+            if node.args or any(kw.arg is None or kw.arg in _DESTINATION_KEYWORDS for kw in node.keywords):
+                raise ValueError(f"file I/O ('{func.attr}' with a path or buffer) is not allowed; print its string result instead")
+            self._checked_renderers.add(func)
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if node.attr.startswith("__") and node.attr.endswith("__"):
+            raise ValueError(f"access to '{node.attr}' is not allowed")
+        if node.attr in _TEXT_OUTPUT_ATTRS:
+            # Only as the callee checked in visit_Call, so it can't be aliased and called with a path
+            if node not in self._checked_renderers:
+                raise ValueError(f"'{node.attr}' may only be called directly, e.g. print(df.{node.attr}())")
+        elif node.attr.startswith(_FORBIDDEN_ATTR_PREFIXES) or node.attr in _FORBIDDEN_ATTRS:
+            raise ValueError(f"file I/O ('{node.attr}') is not allowed; work with 'df' or 'ldf'")
+        self.generic_visit(node)
+
+@functools.lru_cache(maxsize=128)
+def _compile_tool_code(code: str):
+    """
+    Parses, validates and compiles an agent-written snippet, returning (bytecode, error).
+    Rejections are cached too, since ReAct retries often resend the same code.
+    """
+    try:
+        tree = ast.parse(code, "<execute_python>")
+    except SyntaxError as e:
+        return None, f"SyntaxError on line {e.lineno}: {e.msg}"
+    try:
+        _ToolCodeValidator().visit(tree)
+    except ValueError as e:
+        return None, str(e)
+    return compile(tree, "<execute_python>", "exec"), None
+
+# Builtins visible to snippets: everything except the forbidden names the validator rejects
+_TOOL_BUILTINS = {name: value for name, value in vars(builtins).items() if name not in _FORBIDDEN_NAMES}
+
+def _uses_name(code, name: str) -> bool:
+    """Whether a compiled snippet, or any lambda/def/comprehension nested in it, refers to name."""
+    return name in code.co_names or any(
+        _uses_name(const, name) for const in code.co_consts if isinstance(const, type(code))
+    )
+
+def _parse_dates(dates: pd.Series) -> pd.Series:
+    """
+    Parses the date column on pandas' fixed-format fast path (dates are stored as YYYY-MM-DD),
+    only falling back to format inference for the stragglers.
+    """
+    parsed = pd.to_datetime(dates, format="%Y-%m-%d", errors="coerce", cache=True)
+    leftovers = parsed.isna() & dates.notna()
+    if leftovers.any():
+        parsed[leftovers] = pd.to_datetime(dates[leftovers], errors="coerce", cache=True)
+    return parsed
+
+@functools.lru_cache(maxsize=8)
+def _load_csv(data_csv: str) -> pd.DataFrame:
+    """Parsed (and date-typed) DataFrame for a CSV payload; the agent often resends the same data."""
+    df = pd.read_csv(io.StringIO(data_csv))
+    if 'date' in df.columns:
+        df['date'] = _parse_dates(df['date'])
+    return df
 
 class PythonInterpreter:
     """Tool to execute Python code for advanced analysis."""
     
-    def execute_python(self, code: str, data_csv: str = None) -> str:
+    def execute_python(self, code: str, data_csv: str = None, result_id: str = None) -> str:
         """
-        Executes Python code. If 'data_csv' is provided, it's loaded into a DataFrame named 'df'.
-        Always use print() to output results.
+        Executes Python code. The data is loaded into a DataFrame named 'df', either from the
+        'result_id' returned by execute_sql (preferred) or from 'data_csv'. When Polars is
+        installed the same data is also available as a LazyFrame named 'ldf', with 'pl' imported.
+        Imports, open/exec/eval-style builtins, dunder names and attributes, and pandas/NumPy/Polars
+        file reads and writes are rejected; to_csv/to_markdown and similar may be called without a
+        path to get a string. Always use print() to output results.
         """
         print(f"DEBUG: PythonInterpreter executing code...")
+        compiled, error = _compile_tool_code(code)
+        if error:
+            return f"Python Error: {error}"
         output = io.StringIO()
         df = pd.DataFrame()
-        if data_csv:
+        if result_id:
+            stored = _RESULT_STORE.get(result_id)
+            if stored is None:
+                return f"Error: unknown result_id '{result_id}'. Re-run execute_sql."
+            df = stored.copy()
+            if 'date' in df.columns:
+                df['date'] = _parse_dates(df['date'])
+        elif data_csv:
             try:
-                df = pd.read_csv(io.StringIO(data_csv))
-                if 'date' in df.columns:
-                    df['date'] = pd.to_datetime(df['date'])
+                df = _load_csv(data_csv).copy()
             except Exception as e:
                 return f"Error loading data_csv: {str(e)}"
 
         try:
+            # One globals dict, so lambdas, comprehensions and defs in the snippet see pd/np/pl/df too
+            namespace = {"__builtins__": _TOOL_BUILTINS, "df": df, "pd": pd, "np": np}
+            if pl is not None:
+                namespace["pl"] = pl
+                # Only pay for the conversion when the snippet actually uses the LazyFrame
+                if _uses_name(compiled, "ldf"):
+                    namespace["ldf"] = pl.from_pandas(df).lazy()
             with contextlib.redirect_stdout(output):
-                local_vars = {"df": df, "pd": pd, "np": np}
-                exec(code, {}, local_vars)
+                exec(compiled, namespace)
             result = output.getvalue().strip()
             return result or "Code executed successfully."
         except Exception as e:
             return f"Python Error: {str(e)}"
 
+_SYSTEM_PROMPT = (
+    "You are the Expense Explorer AI, powered by Gemini-2.5-Flash-Lite. You help users understand their financial data.\n\n"
+    "REASONING LOOP (ReAct):\n"
+    "1. **Think**: Analyze the user's request. What data do I need?\n"
+    "2. **Schema**: Use 'get_schema' to understand the available tables if unsure.\n"
+    "3. **Query**: For totals, averages or counts per category/merchant/etc., use 'aggregate'. Otherwise use 'execute_sql' to fetch relevant data from the database.\n"
+    "4. **Analyze**: If the query returns data that needs complex processing (trends, math, filtering), use 'execute_python' passing the query's result_id.\n"
+    "5. **Iterate**: If results are unclear or more data is needed, repeat steps 3-4.\n"
+    "6. **Answer**: Provide a clear, Markdown-formatted final response.\n\n"
+    "DATABASE NOTES:\n"
+    "- 'amount' is positive for spending, negative for income/refunds.\n"
+    "- 'date' is stored as a string but can be parsed as datetime in Python.\n"
+    "- Use boolean columns for filtering: 'is_subscription' for recurring costs, 'is_essential' for needs.\n"
+    "- Use SQL for primary filtering/aggregation; use Python for complex logic.\n"
+    "- In 'execute_python', prefer the Polars LazyFrame 'ldf' for group-bys on large results, e.g. "
+    "print(ldf.group_by('category').agg(pl.col('amount').sum()).collect()); 'df' (pandas) is always available."
+)
+
 def get_query_agent():
     """Initializes the Gemma-3 Query Agent with advanced tools."""
     explorer = DatabaseExplorer()
     interpreter = PythonInterpreter()
     
-    system_prompt = (
-        "You are the Expense Explorer AI, powered by Gemini-2.5-Flash-Lite. You help users understand their financial data.\n\n"
-        "REASONING LOOP (ReAct):\n"
-        "1. **Think**: Analyze the user's request. What data do I need?\n"
-        "2. **Schema**: Use 'get_schema' to understand the available tables if unsure.\n"
-        "3. **Query**: Use 'execute_sql' to fetch relevant data from the database.\n"
-        "4. **Analyze**: If the query returns data that needs complex processing (trends, math, filtering), use 'execute_python' passing the CSV result.\n"
-        "5. **Iterate**: If results are unclear or more data is needed, repeat steps 3-4.\n"
-        "6. **Answer**: Provide a clear, Markdown-formatted final response.\n\n"
-        "DATABASE NOTES:\n"
-        "- 'amount' is positive for spending, negative for income/refunds.\n"
-        "- 'date' is stored as a string but can be parsed as datetime in Python.\n"
-        "- Use boolean columns for filtering: 'is_subscription' for recurring costs, 'is_essential' for needs.\n"
-        "- Use SQL for primary filtering/aggregation; use Python for complex logic."
-    )
-    
     agent = Agent(
         name="SophisticatedQueryAgent",
         model="gemini-2.5-flash-lite",
-        instruction=system_prompt,
+        instruction=_SYSTEM_PROMPT,
         tools=[
             explorer.get_schema,
             explorer.execute_sql,
+            explorer.aggregate,
             interpreter.execute_python
         ]
     )
     return agent
 
-async def _get_adk_response(runner, query: str):
+async def _stream_adk_response(runner, query: str) -> AsyncIterator[str]:
+    """Yields the agent's text output event by event as it is produced."""
     session = await runner.session_service.create_session(user_id="query_user", app_name=runner.app_name)
     new_message = types.Content(role="user", parts=[types.Part(text=query)])
     
-    full_output = []
-    from google.adk.utils.context_utils import Aclosing
-    async with Aclosing(runner.run_async(user_id=session.user_id, session_id=session.id, new_message=new_message)) as agen:
-        async for event in agen:
-            if event.content and event.content.parts:
-                text = "".join(p.text for p in event.content.parts if p.text)
-                if text:
-                    full_output.append(text)
-    return "".join(full_output)
+    try:
+        async with Aclosing(runner.run_async(user_id=session.user_id, session_id=session.id, new_message=new_message)) as agen:
+            async for event in agen:
+                if event.content and event.content.parts:
+                    for part in event.content.parts:
+                        if part.text:
+                            yield part.text
+    finally:
+        # The runner is cached for the process; drop the session (question, tool calls, previews)
+        await runner.session_service.delete_session(app_name=runner.app_name, user_id=session.user_id, session_id=session.id)
+
+async def _get_adk_response(runner, query: str) -> str:
+    """Buffers the streamed response for callers that want a single string."""
+    full_output = io.StringIO()
+    async for chunk in _stream_adk_response(runner, query):
+        full_output.write(chunk)
+    return full_output.getvalue()
+
+@functools.lru_cache(maxsize=1)
+def _get_runner() -> InMemoryRunner:
+    """Builds the query Agent and runner once; the tools read the database live on every call."""
+    return InMemoryRunner(agent=get_query_agent())
 
 def run_query(query: str) -> str:
     """Entry point for the Query Agent."""
     init_db()
-    agent = get_query_agent()
-    runner = InMemoryRunner(agent=agent)
+    runner = _get_runner()
     print(f"Running Gemini-2.5-Flash-Lite Agent with query: {query}")
     
     try:
-        import nest_asyncio
-        nest_asyncio.apply()
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(_get_adk_response(runner, query))
+        return asyncio.run_coroutine_threadsafe(_get_adk_response(runner, query), _LOOP).result()
     except Exception as e:
         import traceback
         return f"Error: {str(e)}\n{traceback.format_exc()}"
+
+def run_queries(queries: List[str]) -> List[str]:
+    """Answers several questions concurrently on the shared runner, one ADK session each."""
+    init_db()
+    runner = _get_runner()
+    print(f"Running Gemini-2.5-Flash-Lite Agent with {len(queries)} queries")
+
+    async def _gather():
+        return await asyncio.gather(*(_get_adk_response(runner, query) for query in queries), return_exceptions=True)
+
+    results = asyncio.run_coroutine_threadsafe(_gather(), _LOOP).result()
+    return [f"Error: {str(result)}" if isinstance(result, Exception) else result for result in results]
@@ -1,14 +1,19 @@
 import os
+import io
+import asyncio
+import threading
 from dotenv import load_dotenv
 
 # Ensure environment variables are loaded for database setup
 load_dotenv(override=True)
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, UniqueConstraint, Boolean, text
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime, UniqueConstraint, Index, Boolean, text, select
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.exc import SQLAlchemyError
 from datetime import datetime
-from typing import List
+from typing import Iterator, List
 from pydantic import BaseModel, Field, ConfigDict
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from tensorlake.applications import File
@@ -18,10 +23,52 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     DATABASE_URL = "sqlite:///expenses.db"
 
-engine = create_engine(DATABASE_URL)
+# Rows per multi-row VALUES statement when a bulk insert is split into pages
+INSERT_PAGE_SIZE = 1000
+
+def _engine_options(url: str) -> dict:
+    """Pool settings: a bounded, health-checked pool for servers, shared threads for SQLite."""
+    if url.startswith("sqlite"):
+        options = {"connect_args": {"check_same_thread": False}, "insertmanyvalues_page_size": INSERT_PAGE_SIZE}
+        if ":memory:" in url or url in ("sqlite://", "sqlite:///"):
+            # Every connection to :memory: is a new empty database, so share one
+            options["poolclass"] = StaticPool
+        return options
+    # Neon suspends idle computes after ~5 minutes and drops their connections, so recycle
+    # before that rather than leaning on pre-ping to discover dead ones
+    pool_recycle = 300 if "neon.tech" in url else 1800
+    options = {
+        "pool_size": 10, "max_overflow": 20, "pool_pre_ping": True, "pool_recycle": pool_recycle,
+        # Fail fast into the tenacity retry instead of queueing 30s for a connection
+        "pool_timeout": 10,
+        "insertmanyvalues_page_size": INSERT_PAGE_SIZE,
+    }
+    if url.startswith(("postgresql://", "postgres://", "postgresql+psycopg2://")):
+        # psycopg2: batch plain executemany too, not just INSERTs that use RETURNING
+        options["executemany_mode"] = "values_plus_batch"
+    return options
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside the ingest writer; NORMAL sync is safe under WAL
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # Keep sort/temp b-trees for GROUP BY and window queries off disk
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def dialect_insert(table):
+    """INSERT construct for the active backend, exposing ON CONFLICT clauses on SQLite and Postgres."""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
 # SQLAlchemy Model
 class DBTransaction(Base):
     __tablename__ = "transactions"
@@ -50,6 +97,13 @@ class DBTransaction(Base):
 
     __table_args__ = (
         UniqueConstraint('date', 'description', 'amount', 'source_file', name='_date_desc_amount_file_uc'),
+        # Serves the per-category chronological window scans in insights_logic
+        # (and, as its leading column, plain category filters)
+        Index('ix_transactions_category_date', 'category', 'date'),
+        Index('ix_transactions_merchant', 'merchant'),
+        Index('ix_transactions_date', 'date'),
+        # The unique constraint's index leads with date, so per-statement lookups need their own
+        Index('ix_transactions_source_file', 'source_file'),
     )
 
 class DBStatement(Base):
@@ -67,6 +121,30 @@ class DBStatement(Base):
     total_debits = Column(Float)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+# TensorLake markdown keyed by SHA-256 of the uploaded file, so re-ingesting a PDF skips parsing
+class DBParseCache(Base):
+    __tablename__ = "parse_cache"
+
+    content_sha256 = Column(String, primary_key=True)
+    markdown = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# LLM extraction results keyed by SHA-256 of model + markdown; shared by every container,
+# unlike the extractor's on-disk cache
+class DBExtractionCache(Base):
+    __tablename__ = "llm_extract_cache"
+
+    content_sha256 = Column(String, primary_key=True)
+    payload = Column(String, nullable=False)  # TransactionList JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Applied schema version; init_db skips the migration checks once this is current
+class DBSchemaMeta(Base):
+    __tablename__ = "_schema_meta"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
 # Insights Model
 class DBInsight(Base):
     __tablename__ = "insights"
@@ -86,6 +164,9 @@ class DBInsight(Base):
 
 # Pydantic Models for API/Logic
 class Transaction(BaseModel):
+    # LLM output: tolerate undeclared fields and stray whitespace instead of failing validation
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     date: str = Field(..., description="The date of the transaction (YYYY-MM-DD)")
     description: str = Field(..., description="The merchant or description of the transaction")
     amount: float = Field(..., description="The transaction amount as a float")
@@ -122,14 +203,34 @@ class IngestionRequest(BaseModel):
     filename: str
 
 
+# Bump whenever a column or index is added below, so existing databases migrate once
+SCHEMA_VERSION = 4
+
+# Set once create_all and the column migration have run, so later calls are free
+_DB_READY = False
+_DB_INIT_LOCK = threading.Lock()
+
+def _applied_schema_version():
+    """Version recorded in _schema_meta, or None on a database that predates it."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT version FROM _schema_meta WHERE id = 1")).scalar()
+    except SQLAlchemyError:
+        return None
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
     retry=retry_if_exception_type(SQLAlchemyError),
     reraise=True
 )
-def init_db() -> List[str]:
+def _migrate_schema(force: bool = False) -> List[str]:
+    global _DB_READY
     from sqlalchemy import inspect
+    applied_version = None if force else _applied_schema_version()
+    if applied_version is not None and applied_version >= SCHEMA_VERSION:
+        _DB_READY = True
+        return [f"Schema is at version {applied_version}; no migration needed."]
     logs = []
     # Create all tables first
     Base.metadata.create_all(bind=engine)
@@ -161,24 +262,81 @@ def init_db() -> List[str]:
             existing_columns = [c['name'] for c in inspector.get_columns('transactions')]
             logs.append(f"Migration: Found columns in 'transactions': {existing_columns}")
             
-            with engine.begin() as conn:
-                for col_name, col_type in new_columns:
-                    if col_name not in existing_columns:
-                        try:
-                            logs.append(f"Migration: Adding column {col_name} to transactions...")
+            missing = [(col_name, col_type) for col_name, col_type in new_columns if col_name not in existing_columns]
+            if missing:
+                try:
+                    # One round-trip for every missing column instead of one per column
+                    with engine.begin() as conn:
+                        if engine.dialect.name == "sqlite":
+                            # SQLite allows one ADD COLUMN per ALTER, and pysqlite only runs
+                            # multiple statements through executescript
+                            conn.connection.driver_connection.executescript(";\n".join(
+                                f'ALTER TABLE transactions ADD COLUMN "{col_name}" {col_type}' for col_name, col_type in missing
+                            ))
+                        else:
+                            # A single multi-clause ALTER is one catalog update and one table pass on Postgres
                             # Use quotes for Postgres safety
-                            conn.execute(text(f'ALTER TABLE transactions ADD COLUMN "{col_name}" {col_type}'))
-                            logs.append(f"Migration: Success adding {col_name}")
-                        except Exception as e:
-                            logs.append(f"Migration error for {col_name}: {str(e)}")
+                            conn.exec_driver_sql("ALTER TABLE transactions " + ", ".join(
+                                f'ADD COLUMN "{col_name}" {col_type}' for col_name, col_type in missing
+                            ))
+                    logs.append(f"Migration: Added columns {[col_name for col_name, _ in missing]} in one batch")
+                except Exception as e:
+                    logs.append(f"Migration: Batched ALTER failed ({str(e)}), adding columns one at a time")
+                    # The batch may have partially applied on SQLite, so look again
+                    existing_columns = [c['name'] for c in inspect(engine).get_columns('transactions')]
+                    with engine.begin() as conn:
+                        for col_name, col_type in missing:
+                            if col_name not in existing_columns:
+                                try:
+                                    logs.append(f"Migration: Adding column {col_name} to transactions...")
+                                    conn.execute(text(f'ALTER TABLE transactions ADD COLUMN "{col_name}" {col_type}'))
+                                    logs.append(f"Migration: Success adding {col_name}")
+                                except Exception as e:
+                                    logs.append(f"Migration error for {col_name}: {str(e)}")
+
+            # create_all only builds indexes with new tables, so add any declared since
+            with engine.begin() as conn:
+                for index in DBTransaction.__table__.indexes:
+                    index.create(bind=conn, checkfirst=True)
         else:
             logs.append("Migration: 'transactions' table does not exist yet.")
             
     except Exception as e:
         logs.append(f"Inspector error: {str(e)}")
+        # Leave _DB_READY unset so the next caller retries the migration
+        return logs
     
+    with engine.begin() as conn:
+        stmt = dialect_insert(DBSchemaMeta).values(id=1, version=SCHEMA_VERSION)
+        conn.execute(stmt.on_conflict_do_update(index_elements=["id"], set_={"version": SCHEMA_VERSION}))
+    logs.append(f"Migration: Recorded schema version {SCHEMA_VERSION}.")
+
+    _DB_READY = True
     return logs
 
+def init_db(force: bool = False) -> List[str]:
+    """
+    Brings the schema up to date once per process; later calls return without touching the database.
+    force=True re-runs every migration check regardless of the process flag and stored version.
+    """
+    if _DB_READY and not force:
+        return ["Schema already initialized in this process."]
+    # Threads racing on a cold start would otherwise each run the DDL
+    with _DB_INIT_LOCK:
+        if _DB_READY and not force:
+            return ["Schema already initialized in this process."]
+        return _migrate_schema(force)
+
+# Above this many rows, Postgres saves go through COPY into a staging table instead of INSERT
+COPY_THRESHOLD_ROWS = 2000
+
+# Built once and reused so its compiled form stays in SQLAlchemy's statement cache. The database
+# skips rows that hit the unique constraint and RETURNING reports only the inserted ones,
+# so no existence lookups are needed first.
+_INSERT_NEW_TRANSACTIONS = dialect_insert(DBTransaction).on_conflict_do_nothing(
+    index_elements=["date", "description", "amount", "source_file"]
+).returning(DBTransaction.id)
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
@@ -186,50 +344,64 @@ def init_db() -> List[str]:
     reraise=True
 )
 def save_transactions(transactions: List[Transaction]) -> int:
-    init_db()
-    session = SessionLocal()
-    new_count = 0
+    """Inserts transactions not already stored. Callers run init_db() once beforehand."""
+    if not transactions:
+        return 0
+    # De-duplicate within the batch, keyed like _date_desc_amount_file_uc
+    rows_by_key = {}
+    for tx in transactions:
+        source_file = tx.source_file or "unknown"
+        rows_by_key.setdefault((tx.date, tx.description, tx.amount, source_file), {**tx.model_dump(), "source_file": source_file})
+
+    rows = list(rows_by_key.values())
+    with SessionLocal.begin() as session:
+        if len(rows) > COPY_THRESHOLD_ROWS and engine.dialect.name == "postgresql":
+            return _copy_new_transactions(session, rows)
+        inserted = session.execute(_INSERT_NEW_TRANSACTIONS, rows).all()
+    return len(inserted)
+
+def _copy_field(value) -> str:
+    """A value in COPY's text format: \\N for NULL, with backslash and separators escaped."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _copy_new_transactions(session, rows: List[dict]) -> int:
+    """
+    Streams rows into a temporary staging table with COPY, then moves the new ones across
+    with one INSERT ... SELECT that skips duplicates. Returns the number inserted.
+    """
+    columns = [*Transaction.model_fields, "created_at"]
+    created_at = datetime.utcnow()
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_field(row.get(column, created_at)) for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    cursor = session.connection().connection.cursor()
     try:
-        for tx in transactions:
-            # Check for existing transaction with same date, description, amount, and source_file
-            exists = session.query(DBTransaction).filter(
-                DBTransaction.date == tx.date,
-                DBTransaction.description == tx.description,
-                DBTransaction.amount == tx.amount,
-                DBTransaction.source_file == (tx.source_file or "unknown")
-            ).first()
-            
-            if not exists:
-                db_tx = DBTransaction(
-                    date=tx.date,
-                    description=tx.description,
-                    amount=tx.amount,
-                    category=tx.category,
-                    location=tx.location,
-                    source_file=tx.source_file or "unknown",
-                    merchant=tx.merchant,
-                    is_subscription=tx.is_subscription,
-                    payment_method=tx.payment_method,
-                    tags=tx.tags,
-                    currency=tx.currency,
-                    raw_description=tx.raw_description,
-                    transaction_type=tx.transaction_type,
-                    reference_number=tx.reference_number,
-                    account_last_4=tx.account_last_4,
-                    provider_name=tx.provider_name,
-                    is_essential=tx.is_essential,
-                    tax_category=tx.tax_category,
-                    confidence=tx.confidence
-                )
-                session.add(db_tx)
-                new_count += 1
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
+        cursor.execute("CREATE TEMP TABLE transactions_stage (LIKE transactions INCLUDING DEFAULTS) ON COMMIT DROP")
+        cursor.copy_expert(f"COPY transactions_stage ({column_list}) FROM STDIN", buffer)
+        cursor.execute(
+            f"INSERT INTO transactions ({column_list}) SELECT {column_list} FROM transactions_stage "
+            "ON CONFLICT ON CONSTRAINT _date_desc_amount_file_uc DO NOTHING"
+        )
+        return cursor.rowcount
     finally:
-        session.close()
-    return new_count
+        cursor.close()
+
+async def save_transactions_async(transactions: List[Transaction]) -> int:
+    """save_transactions for async callers: the write runs on a worker thread so the event loop keeps serving."""
+    return await asyncio.to_thread(save_transactions, transactions)
+
+# Plain column selects return Row tuples, skipping ORM instances and identity-map bookkeeping.
+# The column lists follow the pydantic models, so a new field is read back without edits here.
+_TRANSACTION_COLUMNS = [DBTransaction.__table__.c[name] for name in Transaction.model_fields]
+_STATEMENT_COLUMNS = [DBStatement.__table__.c.source_file] + [
+    DBStatement.__table__.c[name] for name in StatementMetadata.model_fields
+]
 
 @retry(
     stop=stop_after_attempt(3),
@@ -238,35 +410,17 @@ def save_transactions(transactions: List[Transaction]) -> int:
     reraise=True
 )
 def get_all_transactions() -> List[dict]:
-    session = SessionLocal()
-    try:
-        transactions = session.query(DBTransaction).all()
-        return [
-            {
-                "date": tx.date,
-                "description": tx.description,
-                "amount": tx.amount,
-                "category": tx.category,
-                "location": tx.location,
-                "source_file": tx.source_file,
-                "merchant": tx.merchant,
-                "is_subscription": tx.is_subscription,
-                "payment_method": tx.payment_method,
-                "tags": tx.tags,
-                "currency": tx.currency,
-                "raw_description": tx.raw_description,
-                "transaction_type": tx.transaction_type,
-                "reference_number": tx.reference_number,
-                "account_last_4": tx.account_last_4,
-                "provider_name": tx.provider_name,
-                "is_essential": tx.is_essential,
-                "tax_category": tx.tax_category,
-                "confidence": tx.confidence
-            }
-            for tx in transactions
-        ]
-    finally:
-        session.close()
+    return list(iter_transactions())
+
+# Rows per fetch when streaming; bounds memory however large the table grows
+TRANSACTION_STREAM_BATCH = 1000
+
+def iter_transactions() -> Iterator[dict]:
+    """Yields transactions one at a time over a server-side cursor instead of loading them all."""
+    stmt = select(*_TRANSACTION_COLUMNS).execution_options(yield_per=TRANSACTION_STREAM_BATCH)
+    with SessionLocal() as session:
+        for row in session.execute(stmt).mappings():
+            yield dict(row)
 
 @retry(
     stop=stop_after_attempt(3),
@@ -275,8 +429,7 @@ def get_all_transactions() -> List[dict]:
     reraise=True
 )
 def save_statement_metadata(source_file: str, meta: StatementMetadata):
-    session = SessionLocal()
-    try:
+    with SessionLocal.begin() as session:
         exists = session.query(DBStatement).filter(DBStatement.source_file == source_file).first()
         if exists:
             exists.provider_name = meta.provider_name
@@ -300,12 +453,6 @@ def save_statement_metadata(source_file: str, meta: StatementMetadata):
                 total_debits=meta.total_debits
             )
             session.add(db_stmt)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
 @retry(
     stop=stop_after_attempt(3),
@@ -314,25 +461,43 @@ def save_statement_metadata(source_file: str, meta: StatementMetadata):
     reraise=True
 )
 def get_statement_metadata(source_file: str = None) -> List[dict]:
-    session = SessionLocal()
-    try:
-        query = session.query(DBStatement)
+    with SessionLocal() as session:
+        query = select(*_STATEMENT_COLUMNS)
         if source_file:
-            query = query.filter(DBStatement.source_file == source_file)
-        statements = query.all()
-        return [
-            {
-                "source_file": s.source_file,
-                "provider_name": s.provider_name,
-                "account_last_4": s.account_last_4,
-                "period_start": s.period_start,
-                "period_end": s.period_end,
-                "opening_balance": s.opening_balance,
-                "closing_balance": s.closing_balance,
-                "total_credits": s.total_credits,
-                "total_debits": s.total_debits
-            }
-            for s in statements
-        ]
-    finally:
-        session.close()
+            query = query.where(DBStatement.source_file == source_file)
+        return [dict(row) for row in session.execute(query).mappings()]
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    retry=retry_if_exception_type(SQLAlchemyError),
+    reraise=True
+)
+def get_cached_markdown(content_sha256: str) -> str | None:
+    with SessionLocal() as session:
+        return session.execute(
+            select(DBParseCache.markdown).where(DBParseCache.content_sha256 == content_sha256)
+        ).scalar()
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    retry=retry_if_exception_type(SQLAlchemyError),
+    reraise=True
+)
+def save_cached_markdown(content_sha256: str, markdown: str):
+    stmt = dialect_insert(DBParseCache).values(content_sha256=content_sha256, markdown=markdown)
+    with SessionLocal.begin() as session:
+        session.execute(stmt.on_conflict_do_nothing(index_elements=["content_sha256"]))
+
+# Cache lookups are best-effort, so unlike the helpers above they fail fast rather than retry
+def get_cached_extraction(content_sha256: str) -> str | None:
+    with SessionLocal() as session:
+        return session.execute(
+            select(DBExtractionCache.payload).where(DBExtractionCache.content_sha256 == content_sha256)
+        ).scalar()
+
+def save_cached_extraction(content_sha256: str, payload: str):
+    stmt = dialect_insert(DBExtractionCache).values(content_sha256=content_sha256, payload=payload)
+    with SessionLocal.begin() as session:
+        session.execute(stmt.on_conflict_do_nothing(index_elements=["content_sha256"]))
@@ -1,15 +1,14 @@
 import http.server
-import socketserver
 import os
-import json
-import urllib.request
-import urllib.error
 import sys
+import requests
+from requests.adapters import HTTPAdapter
 
 # Configuration
 PORT = 8001
 API_BASE = "https://api.tensorlake.ai/v1/namespaces/default"
 API_KEY = os.environ.get("TENSORLAKE_API_KEY")
+PROXY_CHUNK_SIZE = 64 * 1024
 
 if not API_KEY:
     print("Error: TENSORLAKE_API_KEY environment variable not set.")
@@ -27,6 +26,10 @@ if not API_KEY:
     print("CRITICAL: Could not find API Key.")
     sys.exit(1)
 
+# Shared by every handler thread so upstream calls reuse pooled keep-alive TLS connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
 class ProxyHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         if self.path.startswith("/api/proxy/"):
@@ -53,42 +56,47 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
             content_length = int(self.headers.get('Content-Length', 0))
             data = self.rfile.read(content_length)
 
-        # Prepare request
-        req = urllib.request.Request(target_url, data=data, method=method)
-        
         # Use key from header if provided, otherwise fallback to server's key
         user_key = self.headers.get('X-TensorLake-API-Key')
         final_key = user_key if user_key else API_KEY
         
-        req.add_header("Authorization", f"Bearer {final_key}")
-        req.add_header("Content-Type", "application/json")
-        req.add_header("Accept", "application/json")
+        headers = {
+            "Authorization": f"Bearer {final_key}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
 
+        headers_sent = False
         try:
-            with urllib.request.urlopen(req) as response:
-                self.send_response(response.status)
+            with SESSION.request(method, target_url, data=data, headers=headers, timeout=60, stream=True) as response:
+                self.send_response(response.status_code)
                 # Forward headers
-                for k, v in response.getheaders():
-                    # Skip hop-by-hop headers
-                    if k.lower() not in ['transfer-encoding', 'connection', 'keep-alive']:
+                for k, v in response.headers.items():
+                    # Skip hop-by-hop headers; requests decodes any content-encoding, so the
+                    # length changes too (HTTP/1.0 responses end when the connection closes)
+                    if k.lower() not in ['transfer-encoding', 'connection', 'keep-alive', 'content-encoding', 'content-length']:
                         self.send_header(k, v)
                 self.send_header("Access-Control-Allow-Origin", "*") # Allow local
                 self.end_headers()
-                self.wfile.write(response.read())
+                headers_sent = True
+                # Relay the body as it arrives instead of buffering it all first
+                for chunk in response.iter_content(PROXY_CHUNK_SIZE):
+                    self.wfile.write(chunk)
 
-        except urllib.error.HTTPError as e:
-            self.send_response(e.code)
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            self.wfile.write(e.read())
         except Exception as e:
             print(f"Proxy Error: {e}")
-            self.send_error(500, str(e))
+            if headers_sent:
+                # Part of the body is already out; a second response would land inside it,
+                # so drop the connection and let the client see a truncated body
+                self.close_connection = True
+            else:
+                self.send_error(500, str(e))
 
 print(f"Starting proxy server at http://localhost:{PORT}")
 print(f"Proxying requests to {API_BASE}")
 
-with socketserver.TCPServer(("", PORT), ProxyHandler) as httpd:
+# One thread per connection, so a slow upstream call no longer blocks every other request
+with http.server.ThreadingHTTPServer(("", PORT), ProxyHandler) as httpd:
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -0,0 +1,92 @@
+import os
+import re
+
+import pytest
+
+# schema builds its engine at import time; keep the tests off any configured database
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("tensorlake")
+
+from schema import Transaction, _copy_field, _copy_new_transactions  # noqa: E402
+
+_COPY_ESCAPES = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+
+
+def _decode_copy_field(field: str):
+    """Inverse of COPY's text format for the escapes _copy_field emits."""
+    if field == "\\N":
+        return None
+    return re.sub(r"\\(.)", lambda m: _COPY_ESCAPES[m.group(1)], field)
+
+
+def _decode_copy_line(line: str) -> list:
+    # Escaped tabs and newlines never appear raw, so splitting on them is safe
+    return [_decode_copy_field(field) for field in line.split("\t")]
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("a\tb", "a\\tb"),
+    ("back\\slash", "back\\\\slash"),
+    ("line\nbreak", "line\\nbreak"),
+    ("carriage\rreturn", "carriage\\rreturn"),
+    ("\\N", "\\\\N"),
+    ("", ""),
+    (None, "\\N"),
+])
+def test_copy_field_escapes(value, expected):
+    assert _copy_field(value) == expected
+
+
+@pytest.mark.parametrize("value", ["a\tb", "x\\ty", "end\\", "\\N", "two\n\nlines\r\n", "", None])
+def test_copy_field_round_trips(value):
+    assert _decode_copy_field(_copy_field(value)) == value
+
+
+class _CapturingCursor:
+    rowcount = 0
+
+    def __init__(self):
+        self.copied = None
+
+    def execute(self, sql):
+        pass
+
+    def copy_expert(self, sql, buffer):
+        self.copied = buffer.read()
+
+    def close(self):
+        pass
+
+
+class _CapturingSession:
+    """Just enough of a Session for session.connection().connection.cursor()."""
+
+    def __init__(self, cursor):
+        self.connection_ = type("DBAPIConnection", (), {"cursor": lambda _self: cursor})()
+
+    def connection(self):
+        return type("Connection", (), {"connection": self.connection_})()
+
+
+def test_copy_new_transactions_buffer_round_trips():
+    cursor = _CapturingCursor()
+    session = _CapturingSession(cursor)
+
+    tx = Transaction(
+        date="2024-01-31", description="TAB\tAND\\SLASH", amount=-12.5, category="Dining",
+        raw_description="first line\nsecond line", tags="", merchant=None, source_file="stmt.pdf",
+    )
+    row = {**tx.model_dump(), "source_file": "stmt.pdf"}
+    _copy_new_transactions(session, [row])
+
+    lines = cursor.copied.split("\n")
+    assert lines[-1] == "" and len(lines) == 2
+    decoded = dict(zip([*Transaction.model_fields, "created_at"], _decode_copy_line(lines[0])))
+    assert decoded["description"] == "TAB\tAND\\SLASH"
+    assert decoded["raw_description"] == "first line\nsecond line"
+    # NULL and empty string stay distinct
+    assert decoded["merchant"] is None
+    assert decoded["tags"] == ""
+    assert decoded["amount"] == "-12.5"
+    assert decoded["created_at"] is not None
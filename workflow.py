@@ -1,45 +1,75 @@
 from tensorlake.applications import application, function, Image, File
 import os
-import sys
+import base64
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
 from dotenv import load_dotenv
 
 # Ensure environment variables are loaded
 load_dotenv(override=True)
 
-from schema import Transaction, init_db, save_transactions, get_all_transactions, IngestionRequest
+from schema import (
+    init_db, save_transactions, save_statement_metadata, get_cached_markdown, save_cached_markdown, IngestionRequest
+)
 from extractor_logic import extract_transactions_agent, TransactionList
+from ingest import get_client, INGEST_PARALLELISM
+# query_agent (ADK) and insights_logic (litellm) stay imported inside the apps that use them,
+# so ingestion containers don't pay for their imports on cold start
+
+# Dumping multi-MB OCR output to the function logs is slow, so only do it on request
+DEBUG_MARKDOWN = os.getenv("DEBUG_MARKDOWN") == "1"
 
 # Define the container image for the functions
 image = Image(name="expense-explorer-v3")
-image.run("pip install litellm google-genai pydantic sqlalchemy psycopg2-binary openai-agents python-dotenv requests tenacity pandas numpy google-adk nest-asyncio \"protobuf>=6.0\"")
+# Each run() is its own build layer: the slow-moving data stack first, so bumping the
+# fast-moving LLM SDKs only rebuilds the thin layer on top
+image.run("pip install --no-cache-dir pydantic sqlalchemy psycopg2-binary python-dotenv requests tenacity pandas numpy polars \"protobuf>=6.0\"")
+image.run("pip install --no-cache-dir litellm google-genai google-adk openai-agents")
 
 
-@function(image=image, secrets=["TENSORLAKE_API_KEY", "GEMINI_API_KEY"])
+@function(image=image, secrets=["TENSORLAKE_API_KEY", "GEMINI_API_KEY", "DATABASE_URL"])
 def parse_statement(file: File) -> str:
     """Node that converts PDF (passed as File object) to Markdown."""
-    from ingest import TensorLakeV2RESTClient
-    
-    client = TensorLakeV2RESTClient()
+    client = get_client()
     
     print(f"Parsing file with content type {file.content_type}...")
-    file_id = client.upload_content(file.content, content_type=file.content_type)
+    return _parse_with_cache(client, file.content, file.content_type)
+
+def _parse_with_cache(client, content: bytes, content_type: str, filename: str = "file.pdf") -> str:
+    """Returns the stored markdown for an already-parsed file, otherwise parses it and stores the result."""
+    init_db()
+    digest = hashlib.sha256(content).hexdigest()
+    markdown = get_cached_markdown(digest)
+    if markdown is not None:
+        print(f"Using cached markdown for {digest[:12]}.")
+        return markdown
+    file_id = client.upload_content(content, filename, content_type)
     markdown = client.parse_to_markdown(file_id)
+    save_cached_markdown(digest, markdown)
     return markdown
 
-@function(image=image, secrets=["TENSORLAKE_API_KEY", "GEMINI_API_KEY"])
+@function(image=image, secrets=["TENSORLAKE_API_KEY", "GEMINI_API_KEY", "DATABASE_URL"])
 def extract_transactions(markdown: str) -> TransactionList:
     """Node that uses Gemma 3 agent to extract transactions."""
-    print("--- EXTRACTED OCR (MARKDOWN) ---")
-    print(markdown)
-    print("-------------------------------")
-    print("Extracting transactions...")
+    if DEBUG_MARKDOWN:
+        print("--- EXTRACTED OCR (MARKDOWN) ---")
+        print(markdown)
+        print("-------------------------------")
+    print(f"Extracting transactions from {len(markdown)} chars of markdown...")
+    # The extraction cache lives in the database, so make sure its table exists
+    init_db()
     transaction_list = extract_transactions_agent(markdown)
     return transaction_list
 
 @function(image=image, secrets=["DATABASE_URL"])
 def persist_transactions(tx_list: TransactionList, filename: str) -> int:
     """Node that saves extracted transactions and statement metadata to the cloud database."""
-    from schema import init_db, save_transactions, save_statement_metadata
+    return _persist_extraction(tx_list, filename)
+
+def _persist_extraction(tx_list: TransactionList, filename: str) -> int:
     print(f"Persisting {len(tx_list.transactions)} transactions and metadata for {filename}...")
     init_db()
     
@@ -62,10 +92,9 @@ def expense_ingestion_app(request: IngestionRequest) -> int:
     """
     Ingests PDF statements, extracts transactions, and saves them to Neon Postgres.
     """
-    import base64
-    from tensorlake.applications import File
-    
     file_bytes = base64.b64decode(request.file_b64)
+    # Drop the base64 text before parsing so it isn't resident alongside the decoded PDF
+    request.file_b64 = ""
     file_obj = File(content=file_bytes, content_type=request.content_type)
     
     markdown = parse_statement(file_obj)
@@ -73,6 +102,41 @@ def expense_ingestion_app(request: IngestionRequest) -> int:
     count = persist_transactions(tx_list, request.filename)
     return count
 
+# Concurrent Gemini extractions in a batch ingestion; parsing uses INGEST_PARALLELISM threads
+BATCH_EXTRACT_CONCURRENCY = 4
+
+@application()
+@function(image=image, secrets=["TENSORLAKE_API_KEY", "GEMINI_API_KEY", "DATABASE_URL"])
+def expense_ingestion_batch_app(requests: List[IngestionRequest]) -> int:
+    """
+    Ingests several PDF statements at once. Each file is parsed and extracted on a worker
+    thread while finished files are persisted here, so the stages overlap across files.
+    """
+    client = get_client()
+    # Parsing is pure network wait; extraction is held back to respect Gemini rate limits
+    extract_slots = threading.BoundedSemaphore(BATCH_EXTRACT_CONCURRENCY)
+
+    def _parse_and_extract(request: IngestionRequest) -> TransactionList:
+        content = base64.b64decode(request.file_b64)
+        request.file_b64 = ""
+        markdown = _parse_with_cache(client, content, request.content_type, request.filename)
+        del content
+        with extract_slots:
+            return extract_transactions_agent(markdown)
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=INGEST_PARALLELISM) as executor:
+        futures = {executor.submit(_parse_and_extract, request): request for request in requests}
+        for future in as_completed(futures):
+            filename = futures[future].filename
+            # A failed parse, extraction or save costs only this file; later files still persist
+            try:
+                total += _persist_extraction(future.result(), filename)
+            except Exception as e:
+                print(f"[{filename}] Error: {e}")
+                traceback.print_exc()
+    return total
+
 @application()
 @function(image=image, secrets=["DATABASE_URL", "GEMINI_API_KEY"])
 def expense_query_app(user_query: str) -> str:
@@ -86,11 +150,27 @@ def expense_query_app(user_query: str) -> str:
         result = run_query(user_query)
         return result
     except Exception as e:
-        import traceback
         error_msg = f"Error in expense_query_app: {str(e)}\n{traceback.format_exc()}"
         print(error_msg)
         return error_msg
 
+@application()
+@function(image=image, secrets=["DATABASE_URL", "GEMINI_API_KEY"])
+def expense_batch_query_app(user_queries: List[str]) -> List[str]:
+    """
+    Answers several questions in one call; the agent runs them concurrently, overlapping
+    their LLM round-trips. Answers are returned in the order of the questions.
+    """
+    from query_agent import run_queries
+
+    try:
+        print(f"Querying Gemini 2.5 Flash Agent (ADK) with {len(user_queries)} queries")
+        return run_queries(user_queries)
+    except Exception as e:
+        error_msg = f"Error in expense_batch_query_app: {str(e)}\n{traceback.format_exc()}"
+        print(error_msg)
+        return [error_msg] * len(user_queries)
+
 @application()
 @function(image=image, secrets=["DATABASE_URL", "GEMINI_API_KEY"])
 def insights_app(force_refresh: bool = False) -> dict:
@@ -112,16 +192,17 @@ def insights_app(force_refresh: bool = False) -> dict:
 @function(image=image, secrets=["DATABASE_URL"])
 def force_migrate_app(force: bool = True) -> str:
     """Aggressively forces the database schema to match the current models."""
-    from schema import init_db
     try:
-        logs = init_db()
+        logs = init_db(force=force)
         return "\n".join(logs)
     except Exception as e:
         return f"Migration failed: {str(e)}"
 
 # Endpoints for deployment
 ingest_app = expense_ingestion_app
+ingest_batch_app = expense_ingestion_batch_app
 query_app = expense_query_app
+batch_query_app = expense_batch_query_app
 insights = insights_app
 migrate = force_migrate_app
 